@@ -1,6 +1,8 @@
 import gym
 import numpy as np
-from PIL import Image
+
+from deep_rfs.envs.frame_stack import FrameStack
+from deep_rfs.utils.preprocessing import FramePreprocessor
 
 
 class Atari(gym.Env):
@@ -14,48 +16,74 @@ class Atari(gym.Env):
         'video.frames_per_second': 15
     }
 
-    def __init__(self, name='PongDeterministic-v4', clip_reward=False):
+    def __init__(self, name='PongDeterministic-v4', clip_reward=False,
+                 repeat=1, max_pool=False):
+        """
+        :param name: name of the Gym environment
+        :param clip_reward: whether to clip rewards to [-1, 1]
+        :param repeat: number of emulator steps for which each action is
+        repeated (only the last observation is preprocessed)
+        :param max_pool: whether the new frame is the pixel-wise maximum of the
+        last two observations of the repeated steps (to remove flickering)
+        """
         self.IMG_SIZE = (84, 110)
-        self.state_shape = (4, 110, 84)
+        self.CROP = (2, 110)  # Rows of the resized frames used by the encoders
+        self.state_shape = (4, 108, 84)
         self.gamma = 0.99
 
         self.env = gym.make(name)
         self.action_space = self.env.action_space
         self.action_space.values = range(self.action_space.n)
         self.observation_space = self.env.observation_space
+        self.preprocessor = FramePreprocessor(self.observation_space.shape[:2],
+                                              self.IMG_SIZE[::-1],
+                                              crop=self.CROP)
+        self.frame_stack = FrameStack(self.state_shape[0], self.state_shape[1:])
 
         self.clip_reward = clip_reward
+        self.repeat = repeat
+        self.max_pool = max_pool
+        self.lives = None
 
         # initialize state
         self.seed()
         self.reset()
 
     def _reset(self, state=None):
-        state = self._preprocess_observation(self.env.reset())
-        self.env.state = np.array([state, state, state, state])
+        self.frame_stack.reset(self._preprocess_observation(self.env.reset()))
+        self.lives = self.env.env.ale.lives()
         return self._get_state()
 
     def _step(self, action):
-        current_state = self._get_state()
-        obs, reward, done, info = self.env.step(int(action))
-        reward = np.round(reward)
+        # Repeat the action, keeping the last two observations
+        total_reward = 0
+        obs = previous_obs = None
+        for _ in range(self.repeat):
+            previous_obs = obs
+            obs, reward, done, info = self.env.step(int(action))
+            reward = np.round(reward)
+            if self.clip_reward:
+                reward = np.clip(reward, -1, 1)
+            total_reward += reward
+            if done:
+                break
+
+        if self.max_pool and previous_obs is not None:
+            obs = np.maximum(obs, previous_obs)
 
-        if self.clip_reward:
-            reward = np.clip(reward, -1, 1)
+        # Lives lost during the repeated steps
+        info['life_lost'] = info['ale.lives'] != self.lives
+        self.lives = info['ale.lives']
 
-        obs = self._preprocess_observation(obs)
-        self.env.state = self._get_next_state(current_state, obs)
+        # The new observation replaces the oldest frame of the state
+        self.frame_stack.push(self._preprocess_observation(obs))
 
-        return self._get_state(), reward, done, info
+        return self._get_state(), total_reward, done, info
 
     def _get_state(self):
-        return self.env.state
+        # A view on the frame stack, which is overwritten by the next step
+        return self.frame_stack.state()
 
     def _preprocess_observation(self, obs):
-        image = Image.fromarray(obs, 'RGB').convert('L').resize(self.IMG_SIZE)
-        return np.asarray(image.getdata(), dtype=np.uint8).reshape(image.size[1],
-                                                                   image.size[0])  # Convert to array and return
-
-    def _get_next_state(self, current, obs):
-        # Next state is composed by the last 3 images of the previous state and the new observation
-        return np.append(current[1:], [obs], axis=0)
+        # Greyscale, resize and crop (obs can also be a batch of observations)
+        return self.preprocessor(obs)
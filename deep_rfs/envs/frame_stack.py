@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class FrameStack:
+    def __init__(self, history, frame_shape, dtype=np.uint8):
+        """
+        Stack of the last `history` frames of an environment, kept in a ring
+        buffer: each new frame is written in place (twice, so that the stack
+        is always a contiguous slice of the buffer) and the stacked state is a
+        view, so no array is allocated at each step.
+        Since the state is a view, it changes when a new frame is pushed:
+        copy it to keep it.
+        :param history: number of frames in a state
+        :param frame_shape: shape of a frame
+        :param dtype: type of the frames
+        """
+        self.history = history
+        self.buffer = np.zeros((2 * history,) + tuple(frame_shape), dtype=dtype)
+        self.position = 0  # Index of the most recent frame
+
+    def reset(self, frame):
+        """
+        Fills the stack with the given frame (e.g. the first frame of an
+        episode).
+        """
+        self.buffer[...] = frame
+        self.position = 0
+
+    def push(self, frame):
+        """
+        Adds a frame to the stack, dropping the oldest one.
+        """
+        self.position = (self.position + 1) % self.history
+        self.buffer[self.position] = frame
+        self.buffer[self.position + self.history] = frame
+
+    def state(self):
+        """
+        :return: view of shape (history,) + frame_shape with the stacked
+        frames, from the oldest to the most recent
+        """
+        return self.buffer[self.position + 1:self.position + 1 + self.history]
@@ -0,0 +1,112 @@
+import numpy as np
+
+from deep_rfs.envs.synthetic import DiscreteActions, LivesInterface
+from deep_rfs.utils.datasets import index_stores
+
+
+class ReplayEnv:
+    """
+    Environment that replays the episodes of a SARS' dataset collected with
+    deep_rfs.utils.datasets.collect_sars_to_disk, with the interface of
+    deep_rfs.envs.atari.Atari: each step serves the recorded next state,
+    reward and end of episode, whatever the action (actions that differ from
+    the recorded ones are counted in self.mismatches).
+    Since states are read from the dataset, rollouts run at memory speed and
+    are reproducible, e.g. to profile the per-step cost of the policy and of
+    the collection and evaluation loops separately from the emulator.
+    The recorded states already include the frames of the actions that
+    force the start of the episodes, so rollouts should not use
+    initial_actions. Lives are the number of absorbing transitions left in
+    the episode.
+    """
+
+    def __init__(self, path, clip_reward=False, shuffle=False, seed=None,
+                 preload=True, n_actions=None):
+        """
+        :param path: path to folder containing 'sars_*' frame stores
+        :param clip_reward: whether to clip the recorded rewards to [-1, 1]
+        :param shuffle: whether to replay the episodes in random order (in
+        recorded order otherwise, cycling when all have been replayed)
+        :param seed: seed of the order of the episodes
+        :param preload: whether to read the frames of the dataset in memory
+        (otherwise they are memory-mapped)
+        :param n_actions: number of actions (the largest recorded action + 1
+        by default)
+        """
+        index, self.stores, store_idx, rows = index_stores(path)
+        if preload:
+            for store in self.stores:
+                store.frames = np.array(store.frames)
+
+        # Order the transitions by time (shards may be shuffled), then split
+        # them at the changes of episode
+        s = np.empty(len(index), dtype=np.int64)
+        for i, store in enumerate(self.stores):
+            mask = store_idx == i
+            s[mask] = np.asarray(store.s)[rows[mask]]
+        order = np.lexsort((s, index['episode'], index['block']))
+        self.store_idx = store_idx[order]
+        self.rows = rows[order]
+        self.r = np.asarray(index['r'])[order]
+        self.a = np.asarray(index['a'])[order]
+        self.done = np.asarray(index['done'])[order]
+        episode = np.asarray(index['episode'])[order]
+        starts = np.flatnonzero(np.r_[True, episode[1:] != episode[:-1]])
+        self.episodes = np.c_[starts, np.r_[starts[1:], len(order)]]
+
+        self.gamma = 0.99
+        self.state_shape = (self.stores[0].history,) + tuple(self.stores[0].frame_shape)
+        self.state = np.zeros((1,) + self.state_shape, dtype=np.uint8)
+        self.rng = np.random.RandomState(seed)
+        self.env = LivesInterface(self)
+        if n_actions is None:
+            n_actions = int(self.a.max()) + 1
+        self.action_space = DiscreteActions(n_actions, self.rng)
+        self.clip_reward = clip_reward
+        self.shuffle = shuffle
+        self.mismatches = 0
+
+        self.next_episode = 0
+        self.position = self.stop = None
+        self.lives = 0
+
+    def _load_state(self, t, column):
+        store = self.stores[self.store_idx[t]]
+        store.stack(getattr(store, column)[self.rows[t]:self.rows[t] + 1],
+                    out=self.state)
+        # A view on the state, which is overwritten by the next step
+        return self.state[0]
+
+    def reset(self):
+        if self.shuffle:
+            episode = self.rng.randint(len(self.episodes))
+        else:
+            episode = self.next_episode
+            self.next_episode = (self.next_episode + 1) % len(self.episodes)
+        self.position, self.stop = self.episodes[episode]
+        self.lives = int(np.count_nonzero(self.done[self.position:self.stop]))
+        return self._load_state(self.position, 's')
+
+    def step(self, action):
+        t = self.position
+        if int(action) != self.a[t]:
+            self.mismatches += 1
+        reward = self.r[t]
+        if self.clip_reward:
+            reward = np.clip(reward, -1, 1)
+        lives = self.lives
+        if self.done[t]:
+            self.lives = max(self.lives - 1, 0)
+        self.position += 1
+        done = self.position == self.stop
+
+        state = self._load_state(t, 'ss')
+        info = {'ale.lives': self.lives, 'life_lost': self.lives != lives,
+                'recorded_action': int(self.a[t])}
+        return state, reward, done, info
+
+    def render(self, mode='rgb_array'):
+        """
+        :return: the most recent frame of the current state
+        """
+        return np.array(self.state[0, -1])
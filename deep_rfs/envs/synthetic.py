@@ -0,0 +1,226 @@
+import time
+
+import numpy as np
+
+from deep_rfs.envs.frame_stack import FrameStack
+from deep_rfs.utils.preprocessing import FramePreprocessor
+
+
+class DiscreteActions:
+    def __init__(self, n, rng):
+        """
+        Discrete action space with the attributes of the Gym spaces used in
+        the project.
+        :param n: number of actions
+        :param rng: np.random.RandomState used to sample actions
+        """
+        self.n = n
+        self.values = range(n)
+        self.rng = rng
+
+    def sample(self):
+        return self.rng.randint(self.n)
+
+
+class LivesInterface:
+    # Stands for the ALE interface (env.env.ale.lives()) of the Atari envs
+    def __init__(self, mdp):
+        self.env = self
+        self.ale = self
+        self.mdp = mdp
+
+    def lives(self):
+        return self.mdp.lives
+
+
+class SyntheticAtari:
+    """
+    Deterministic, Breakout-like environment with the interface and the
+    observations of deep_rfs.envs.atari.Atari, which does not need Gym nor
+    the Atari ROMs (e.g. to benchmark and test the pipeline offline).
+    Frames are rendered as 210x160 RGB screens and preprocessed like the
+    frames of Atari.
+    Actions are NOOP, FIRE (launch the ball), RIGHT and LEFT. Hitting a brick
+    is rewarded according to its row, and a life is lost when the ball
+    misses the paddle.
+    """
+
+    SCREEN = (210, 160)
+    WALLS = (32, 196, 8, 152)  # Top, bottom, left and right of the playfield
+    BRICKS_TOP = 57
+    BRICK_SHAPE = (6, 8)
+    BRICK_REWARDS = (7, 7, 4, 4, 1, 1)  # Reward of each row of bricks
+    BRICK_COLORS = ((200, 72, 72), (198, 108, 58), (180, 122, 48),
+                    (162, 162, 42), (72, 160, 72), (66, 72, 200))
+    PADDLE_ROW = 189
+    PADDLE_WIDTH = 16
+    PADDLE_SPEED = 4
+    BALL_SHAPE = (4, 2)
+
+    def __init__(self, seed=None, clip_reward=False, repeat=1, max_pool=False,
+                 frame_skip=4, step_delay=0., lives=5, max_steps=10000):
+        """
+        :param seed: seed of the environment (see seed)
+        :param clip_reward: whether to clip rewards to [-1, 1]
+        :param repeat: number of steps for which each action is repeated (see
+        Atari)
+        :param max_pool: whether to max-pool the last two frames of the
+        repeated steps (see Atari)
+        :param frame_skip: number of simulated frames in a step (like the
+        frame skip of the Gym Atari environments), only the last of which is
+        rendered
+        :param step_delay: time in seconds spent waiting at each step, to
+        emulate the cost of the emulator
+        :param lives: number of lives in an episode
+        :param max_steps: maximum number of steps in an episode
+        """
+        self.IMG_SIZE = (84, 110)
+        self.CROP = (2, 110)  # Rows of the resized frames used by the encoders
+        self.state_shape = (4, 108, 84)
+        self.gamma = 0.99
+
+        self.rng = np.random.RandomState()
+        self.env = LivesInterface(self)
+        self.action_space = DiscreteActions(4, self.rng)
+        self.preprocessor = FramePreprocessor(self.SCREEN, self.IMG_SIZE[::-1],
+                                              crop=self.CROP)
+        self.frame_stack = FrameStack(self.state_shape[0], self.state_shape[1:])
+
+        self.clip_reward = clip_reward
+        self.repeat = repeat
+        self.max_pool = max_pool
+        self.frame_skip = frame_skip
+        self.step_delay = step_delay
+        self.max_lives = lives
+        self.max_steps = max_steps
+
+        # Rows and columns of the bricks
+        self.brick_rows = len(self.BRICK_REWARDS)
+        self.brick_cols = (self.WALLS[3] - self.WALLS[2]) // self.BRICK_SHAPE[1]
+        self.brick_colors = np.repeat(np.array(self.BRICK_COLORS, dtype=np.uint8),
+                                      self.BRICK_SHAPE[0], axis=0)
+
+        # initialize state
+        self.seed(seed)
+        self.reset()
+
+    def seed(self, seed=None):
+        """
+        :param seed: seed of the dynamics (the same seed gives the same
+        episodes for the same actions)
+        """
+        self.rng.seed(seed)
+        return [seed]
+
+    def reset(self):
+        self.lives = self.max_lives
+        self.steps = 0
+        self.bricks = np.ones((self.brick_rows, self.brick_cols), dtype=bool)
+        self.paddle = (self.WALLS[2] + self.WALLS[3] - self.PADDLE_WIDTH) / 2.
+        self.ball = None  # Position and velocity, None until launched
+        self.frame_stack.reset(self.preprocessor(self.render()))
+        return self.frame_stack.state()
+
+    def step(self, action):
+        total_reward = 0
+        frame = previous_frame = None
+        lives = self.lives
+        for _ in range(self.repeat):
+            reward = 0.
+            for _ in range(self.frame_skip):
+                reward += self._simulate(int(action))
+            reward = np.round(reward)
+            if self.clip_reward:
+                reward = np.clip(reward, -1, 1)
+            total_reward += reward
+            if self.step_delay > 0:
+                time.sleep(self.step_delay)
+            self.steps += 1
+            done = self.lives == 0 or self.steps >= self.max_steps
+            if self.max_pool:
+                previous_frame = frame
+            frame = self.render()
+            if done:
+                break
+
+        if previous_frame is not None:
+            frame = np.maximum(frame, previous_frame)
+        self.frame_stack.push(self.preprocessor(frame))
+
+        info = {'ale.lives': self.lives, 'life_lost': self.lives != lives}
+        return self.frame_stack.state(), total_reward, done, info
+
+    def _simulate(self, action):
+        # Advances the game by one frame, returns the reward
+        top, bottom, left, right = self.WALLS
+        if action == 2:
+            self.paddle = min(self.paddle + self.PADDLE_SPEED, right - self.PADDLE_WIDTH)
+        elif action == 3:
+            self.paddle = max(self.paddle - self.PADDLE_SPEED, left)
+
+        if self.ball is None:
+            if action == 1 and self.lives > 0:
+                self.ball = np.array([self.BRICKS_TOP + self.brick_rows * self.BRICK_SHAPE[0] + 20.,
+                                      self.rng.uniform(left + 10, right - 10),
+                                      2., self.rng.choice([-1.5, -1., 1., 1.5])])
+            return 0
+
+        ball = self.ball
+        ball[:2] += ball[2:]
+        if ball[1] < left or ball[1] + self.BALL_SHAPE[1] > right:
+            ball[3] = -ball[3]
+            ball[1] = np.clip(ball[1], left, right - self.BALL_SHAPE[1])
+        if ball[0] < top:
+            ball[2] = abs(ball[2])
+            ball[0] = top
+
+        # Bricks
+        reward = 0
+        row = int((ball[0] - self.BRICKS_TOP) // self.BRICK_SHAPE[0])
+        col = int((ball[1] - left) // self.BRICK_SHAPE[1])
+        if 0 <= row < self.brick_rows and 0 <= col < self.brick_cols \
+                and self.bricks[row, col]:
+            self.bricks[row, col] = False
+            reward = self.BRICK_REWARDS[row]
+            ball[2] = -ball[2]
+            if not self.bricks.any():
+                self.bricks[...] = True  # Next wall
+
+        # Paddle
+        if ball[2] > 0 and ball[0] + self.BALL_SHAPE[0] >= self.PADDLE_ROW:
+            offset = (ball[1] + self.BALL_SHAPE[1] / 2. - self.paddle) / self.PADDLE_WIDTH
+            if 0 <= offset <= 1:
+                ball[2] = -ball[2]
+                ball[3] = 3 * (offset - 0.5) + self.rng.uniform(-0.1, 0.1)
+            elif ball[0] > bottom:
+                self.lives -= 1
+                self.ball = None
+        return reward
+
+    def render(self, mode='rgb_array'):
+        """
+        :return: the current screen as a 210x160 RGB np.array
+        """
+        top, bottom, left, right = self.WALLS
+        screen = np.zeros(self.SCREEN + (3,), dtype=np.uint8)
+        screen[top - 8:top, :] = 142
+        screen[top:bottom, :left] = 142
+        screen[top:bottom, right:] = 142
+
+        # Bricks
+        h, w = self.BRICK_SHAPE
+        bricks = np.repeat(np.repeat(self.bricks, h, axis=0), w, axis=1)
+        region = screen[self.BRICKS_TOP:self.BRICKS_TOP + bricks.shape[0],
+                        left:left + bricks.shape[1]]
+        region[bricks] = np.broadcast_to(self.brick_colors[:, None],
+                                         region.shape)[bricks]
+
+        # Paddle and ball
+        paddle = int(self.paddle)
+        screen[self.PADDLE_ROW:self.PADDLE_ROW + 4,
+               paddle:paddle + self.PADDLE_WIDTH] = self.BRICK_COLORS[0]
+        if self.ball is not None:
+            row, col = int(self.ball[0]), int(self.ball[1])
+            screen[row:row + self.BALL_SHAPE[0], col:col + self.BALL_SHAPE[1]] = \
+                self.BRICK_COLORS[0]
+        return screen
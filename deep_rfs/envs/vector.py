@@ -0,0 +1,157 @@
+import numpy as np
+
+
+class VectorEnv(object):
+    def __init__(self, envs):
+        """
+        Steps several environments (e.g. deep_rfs.envs.atari.Atari instances)
+        in lockstep, so that the actions of all environments can be selected
+        with a single call to the policy (see vector_episodes).
+        The current states of all environments are kept in a single array.
+        :param envs: list of environments with the same state shape
+        """
+        self.envs = list(envs)
+        self.gamma = self.envs[0].gamma
+        self.state_shape = self.envs[0].state_shape
+        self.action_space = self.envs[0].action_space
+        self.states = np.zeros((len(self.envs),) + tuple(self.state_shape),
+                               dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.envs)
+
+    @property
+    def clip_reward(self):
+        return self.envs[0].clip_reward
+
+    @clip_reward.setter
+    def clip_reward(self, clip):
+        for env in self.envs:
+            env.clip_reward = clip
+
+    def _indices(self, indices):
+        return range(len(self.envs)) if indices is None else indices
+
+    def reset(self, indices=None):
+        """
+        :param indices: environments to reset (all if None)
+        :return: the initial states of the environments
+        """
+        indices = self._indices(indices)
+        for i in indices:
+            self.states[i] = self.envs[i].reset()
+        return self.states[indices]
+
+    def step(self, actions, indices=None):
+        """
+        :param actions: the action of each environment
+        :param indices: environments to step (all if None)
+        :return: (states, rewards, dones, infos), the next states, rewards and
+        absorbing flags of the environments as np.arrays, and the list of their
+        info dicts
+        """
+        indices = self._indices(indices)
+        rewards = np.zeros(len(indices))
+        dones = np.zeros(len(indices), dtype=bool)
+        infos = []
+        for k, (i, action) in enumerate(zip(indices, actions)):
+            state, rewards[k], dones[k], info = self.envs[i].step(action)
+            self.states[i] = state
+            infos.append(info)
+        return self.states[indices], rewards, dones, infos
+
+    def lives(self, i):
+        """
+        :param i: index of an environment
+        :return: the number of lives left in the Atari game of the environment
+        """
+        return self.envs[i].env.env.ale.lives()
+
+
+def vector_episodes(venv, policy, episodes, initial_actions=None, repeat=1,
+                    evaluation=False):
+    """
+    Generator of the SARS' transitions of several episodes, collected on the
+    environments of a VectorEnv in lockstep: the actions of all the running
+    episodes are selected with a single call to policy.draw_actions, and an
+    environment starts a new episode as soon as its episode ends, until the
+    given number of episodes has been started.
+    Transitions are the same as in deep_rfs.utils.datasets.episode, and the
+    transitions of different episodes are interleaved.
+
+    :param venv: a VectorEnv
+    :param policy: a policy object (method draw_actions is expected)
+    :param episodes: number of episodes to collect
+    :param initial_actions: list of action indices that start an episode
+    :param repeat: number of times each action is repeated
+    :param evaluation: passed to policy.draw_actions
+    :return: a generator of (episode_id, transition, end) tuples, where end is
+    True for the last transition of an episode
+    """
+    n_envs = len(venv)
+    episode_ids = [None] * n_envs  # Episode run by each env (None if idle)
+    frames = [None] * n_envs  # Frames observed and not yielded yet
+    lives_count = [None] * n_envs
+    lives = [None] * n_envs  # Tracked through the info of the steps
+    infos = [None] * n_envs
+    started = 0
+
+    while True:
+        # Start new episodes on idle envs
+        for i in range(n_envs):
+            if episode_ids[i] is None and started < episodes:
+                state = venv.reset([i])[0]
+                frames[i] = [np.array(frame) for frame in state]
+                if initial_actions is not None:
+                    states, _, _, info = venv.step([np.random.choice(initial_actions)], [i])
+                    frames[i].append(np.array(states[0][-1]))
+                    infos[i] = info[0]
+                    lives_count[i] = info[0]['ale.lives']
+                lives[i] = venv.lives(i)
+                episode_ids[i] = started
+                started += 1
+        active = [i for i in range(n_envs) if episode_ids[i] is not None]
+        if len(active) == 0:
+            return
+
+        # Force start after a life is lost
+        if initial_actions is not None:
+            for i in active:
+                if infos[i]['ale.lives'] < lives_count[i]:
+                    lives_count[i] = infos[i]['ale.lives']
+                    states, _, _, info = venv.step([np.random.choice(initial_actions)], [i])
+                    frames[i].append(np.array(states[0][-1]))
+                    infos[i] = info[0]
+                    lives[i] = info[0]['ale.lives']
+
+        # Select the actions of all envs at once
+        actions = policy.draw_actions(venv.states[active],
+                                      np.zeros(len(active), dtype=bool),
+                                      evaluation=evaluation)
+
+        # Repeat the actions (until the episode of an env ends)
+        next_frames = dict((i, []) for i in active)
+        rewards = dict((i, 0) for i in active)
+        done = dict((i, False) for i in active)
+        life_lost = dict((i, False) for i in active)
+        stepping = list(zip(active, actions))
+        for _ in range(repeat):
+            indices = [i for i, _ in stepping]
+            states, r, d, info = venv.step([int(a) for _, a in stepping], indices)
+            for k, i in enumerate(indices):
+                next_frames[i].append(np.array(states[k][-1]))
+                life_lost[i] = lives[i] != info[k]['ale.lives']
+                lives[i] = info[k]['ale.lives']
+                rewards[i] += r[k]
+                done[i] = done[i] or d[k]
+                infos[i] = info[k]
+            stepping = [(i, a) for i, a in stepping if not done[i]]
+            if len(stepping) == 0:
+                break
+
+        for i, action in zip(active, actions):
+            yield episode_ids[i], (frames[i], int(action), rewards[i],
+                                   next_frames[i], done[i] or life_lost[i]), done[i]
+            frames[i] = []
+            if done[i]:
+                episode_ids[i] = None
@@ -4,6 +4,8 @@ import imageio
 import numpy as np
 from joblib import Parallel, delayed
 
+from deep_rfs.envs.vector import VectorEnv, vector_episodes
+
 
 def evaluate_policy(mdp, policy, metric='cumulative', n_episodes=1,
                     video=False, save_video=False,
@@ -14,8 +16,11 @@ def evaluate_policy(mdp, policy, metric='cumulative', n_episodes=1,
     the specified metric by executing multiple episode, using the
     provided feature extraction model to encode states.
     Params: 
-    :param mdp: the environment on which to run.
-    :param policy: a policy object (method draw_action is expected).
+    :param mdp: the environment on which to run, or a VectorEnv to run the
+    episodes on its environments in lockstep (video and save_video are not
+    supported).
+    :param policy: a policy object (method draw_action is expected, or
+    draw_actions with a VectorEnv).
     :param metric: the evaluation metric ['discounted', 'average', 'cumulative']
     :param n_episodes: the number of episodes to run.
     :param video: whether to render the environment.
@@ -45,15 +50,21 @@ def evaluate_policy(mdp, policy, metric='cumulative', n_episodes=1,
     old_clip = mdp.clip_reward
     mdp.clip_reward = clip
 
-    out = Parallel(n_jobs=n_jobs)(
-        delayed(_eval)(
-            mdp, policy, metric=metric, video=video,
-            save_video=save_video, save_path=save_path,
-            append_filename=('_%s' % append_filename).rstrip('_') + '_%s' % eid,
-            initial_actions=initial_actions
+    if isinstance(mdp, VectorEnv):
+        assert not (video or save_video), \
+            "Videos are not supported with a VectorEnv"
+        out = _eval_vector(mdp, policy, n_episodes, metric=metric,
+                           initial_actions=initial_actions)
+    else:
+        out = Parallel(n_jobs=n_jobs)(
+            delayed(_eval)(
+                mdp, policy, metric=metric, video=video,
+                save_video=save_video, save_path=save_path,
+                append_filename=('_%s' % append_filename).rstrip('_') + '_%s' % eid,
+                initial_actions=initial_actions
+            )
+            for eid in range(n_episodes)
         )
-        for eid in range(n_episodes)
-    )
 
     policy.set_epsilon(old_epsilon)
     mdp.clip_reward = old_clip
@@ -99,7 +110,7 @@ def _eval(mdp, policy, metric='cumulative', video=False, save_video=False,
         lives_count = info['ale.lives']
 
     if save_video:
-        frames.append(state[-1])
+        frames.append(np.array(state[-1]))  # The state is overwritten by the next step
 
     reward = 0
     done = False
@@ -129,7 +140,7 @@ def _eval(mdp, policy, metric='cumulative', video=False, save_video=False,
         # Update state
         state = next_state
         if save_video:
-            frames.append(state[-1])
+            frames.append(np.array(state[-1]))
 
     if metric == 'average':
         ep_performance /= frame_counter
@@ -142,3 +153,37 @@ def _eval(mdp, policy, metric='cumulative', video=False, save_video=False,
         imageio.mimsave(filename, frames)
 
     return ep_performance, frame_counter
+
+
+def _eval_vector(venv, policy, n_episodes, metric='cumulative',
+                 initial_actions=None):
+    """
+    Runs evaluation episodes on the environments of a VectorEnv in lockstep,
+    selecting the actions of all environments with a single call to
+    policy.draw_actions (see deep_rfs.envs.vector.vector_episodes).
+    Params:
+    :param venv: the VectorEnv on which to run.
+    :param policy: a policy object (method draw_actions is expected).
+    :param n_episodes: the number of episodes to run.
+    :param metric: the evaluation metric ['discounted', 'average', 'cumulative']
+    :param initial_actions: actions to use to force start the episode
+
+    :return: list of (ep_performance, frame_counter) for each episode (see
+    _eval)
+    """
+    gamma = venv.gamma if metric == 'discounted' else 1
+    ep_performance = np.zeros(n_episodes)
+    df = np.ones(n_episodes)  # Discount factors
+    frame_counter = np.zeros(n_episodes, dtype=np.int64)
+
+    for eid, (_, _, reward, _, _), _ in vector_episodes(
+            venv, policy, n_episodes, initial_actions=initial_actions,
+            evaluation=True):
+        frame_counter[eid] += 1
+        ep_performance[eid] += df[eid] * reward
+        df[eid] *= gamma
+
+    if metric == 'average':
+        ep_performance /= frame_counter
+
+    return zip(ep_performance, frame_counter)
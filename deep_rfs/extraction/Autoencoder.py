@@ -7,6 +7,9 @@ from keras.models import Model
 from keras.optimizers import *
 from keras.regularizers import l1
 
+from deep_rfs.utils.encoding import ChunkTuner, chunk_limit, encode_in_chunks
+from deep_rfs.utils.preprocessing import preprocess_states
+
 
 class Autoencoder:
     def __init__(self, input_shape, n_features=128, batch_size=32,
@@ -50,6 +53,8 @@ class Autoencoder:
         self.beta = beta
         self.use_dense = use_dense
         self.support = None
+        self.chunk_tuner = ChunkTuner(max_size=chunk_limit(input_shape))
+        self.encode_buffers = {}
 
         # Check flag consistency
         assert self.use_contractive_loss + self.use_vae + self.use_dense <= 1, 'Set at most one flag for contractive, VAE or dense'
@@ -193,21 +198,22 @@ class Autoencoder:
         self.model.compile(optimizer=self.optimizer, loss=self.loss,
                            metrics=['accuracy'])
 
-    def preprocess_state(self, x, binarize=False, binarization_threshold=0.1):
+    def preprocess_state(self, x, binarize=False, binarization_threshold=0.1,
+                         out=None):
         """
         :param x: np.array, a batch of states 
         :param binarize: whether to convert states to a {0, 1} binary space
         :param binarization_threshold: threshold for binarization
+        :param out: float32 np.array in which to write the preprocessed states
+        (e.g. a reusable batch buffer)
         :return: the preprocessed state
         """
-        if not x.shape[1:] == (4, 108, 84):
-            x = x[:, :, 2:, :]
-            assert x.shape[1:] == (4, 108, 84)
-        x = np.asarray(x).astype('float32') / 255.  # To 0-1 range
-        if binarize:
-            x[x < binarization_threshold] = 0
-            x[x >= binarization_threshold] = 1
-
+        # States of 110 rows (collected before Atari cropped its frames) are
+        # cropped to 108
+        x = preprocess_states(x, binarize=binarize,
+                              binarization_threshold=binarization_threshold,
+                              rows=108, out=out)
+        assert x.shape[1:] == (4, 108, 84)
         return x
 
     def fit(self, x, y, validation_data=None):
@@ -235,16 +241,22 @@ class Autoencoder:
                               validation_data=validation_data,
                               callbacks=[self.es, self.mc])
 
-    def fit_generator(self, generator, steps_per_epoch, nb_epochs, validation_data=None):
+    def fit_generator(self, generator, steps_per_epoch, nb_epochs, validation_data=None,
+                      max_q_size=250, validation_steps=None):
         """
         :param generator: generator for batch data 
         :param steps_per_epoch: how many batches in an epoch
         :param nb_epochs: how many epochs to train for
-        :param validation_data: tuple (X, Y) to use as validation data (it will be preprocessed)
+        :param validation_data: tuple (X, Y) to use as validation data (it will
+        be preprocessed), or generator of preprocessed validation batches
+        :param max_q_size: maximum size of Keras's queue of batches (keep it
+        small if the generator already prefetches batches)
+        :param validation_steps: how many batches of the validation generator
+        to evaluate at the end of each epoch
         :return: 
         """
         # Preprocess validation data
-        if validation_data is not None:
+        if isinstance(validation_data, tuple):
             val_x = self.preprocess_state(validation_data[0], binarize=self.binarize, binarization_threshold=self.binarization_threshold)
             val_y = self.preprocess_state(validation_data[1], binarize=self.binarize, binarization_threshold=self.binarization_threshold)
             validation_data = (val_x, val_y)
@@ -252,9 +264,10 @@ class Autoencoder:
         return self.model.fit_generator(generator,
                                         steps_per_epoch,
                                         epochs=nb_epochs,
-                                        max_q_size=250,
+                                        max_q_size=max_q_size,
                                         callbacks=[self.es, self.mc],
-                                        validation_data=validation_data)
+                                        validation_data=validation_data,
+                                        validation_steps=validation_steps)
 
     def predict(self, x):
         """
@@ -272,14 +285,32 @@ class Autoencoder:
         :param x: samples to encode, ignoring the support 
         :return: the encoded samples
         """
-        # Feed input to the model, return encoded images flattened
-        x = self.preprocess_state(x, binarize=self.binarize, binarization_threshold=self.binarization_threshold)
-
         if x.shape[0] == 1:
             # x is a singe sample
+            x = self.preprocess_state(x, binarize=self.binarize, binarization_threshold=self.binarization_threshold)
             return np.asarray(self.encoder.predict_on_batch(x)).flatten()
         else:
-            return np.asarray(self.encoder.predict(x))
+            return self.encode(x)
+
+    def encode(self, x, out=None, chunk_size=None):
+        """
+        Embeds any number of states using the encoder, preprocessing them in
+        chunks (see deep_rfs.utils.encoding.encode_in_chunks).
+        :param x: uint8 states to encode, ignoring the support (np.array or
+        memmap)
+        :param out: np.array or memmap in which to write the features
+        :param chunk_size: number of states encoded at once (tuned by
+        throughput if None)
+        :return: the encoded samples
+        """
+        return encode_in_chunks(
+            self.encoder.predict_on_batch,
+            lambda c, out: self.preprocess_state(c, binarize=self.binarize,
+                                                 binarization_threshold=self.binarization_threshold,
+                                                 out=out),
+            x, self.input_shape, self.encoder.output_shape[1:], out=out,
+            chunk_size=chunk_size, tuner=self.chunk_tuner,
+            buffers=self.encode_buffers)
 
     def s_features(self, x, support=None):
         """
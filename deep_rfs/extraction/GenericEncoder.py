@@ -2,6 +2,9 @@ import numpy as np
 from keras.models import load_model
 from keras.optimizers import Adam
 
+from deep_rfs.utils.encoding import ChunkTuner, chunk_limit, encode_in_chunks
+from deep_rfs.utils.preprocessing import preprocess_states
+
 
 class GenericEncoder:
     def __init__(self, path, binarize=False):
@@ -9,6 +12,8 @@ class GenericEncoder:
 
         self.support = None
         self.binarize = binarize
+        self.chunk_tuner = ChunkTuner(max_size=chunk_limit(self.encoder.input_shape[1:]))
+        self.encode_buffers = {}
 
         # Optimization algorithm
         self.optimizer = Adam()
@@ -21,17 +26,31 @@ class GenericEncoder:
         :param x: samples to encode, ignoring the support 
         :return: the encoded samples
         """
-        # Feed input to the model, return encoded images flattened
-        x = np.asarray(x).astype('float32') / 255  # To 0-1 range
-        if self.binarize:
-            x[x < 0.1] = 0
-            x[x >= 0.1] = 1
-
         if x.shape[0] == 1:
             # x is a singe sample
+            x = preprocess_states(x, binarize=self.binarize, rows=None)
             return np.asarray(self.encoder.predict_on_batch(x)).flatten()
         else:
-            return np.asarray(self.encoder.predict(x))
+            return self.encode(x)
+
+    def encode(self, x, out=None, chunk_size=None):
+        """
+        Embeds any number of states using the encoder, preprocessing them in
+        chunks (see deep_rfs.utils.encoding.encode_in_chunks).
+        :param x: uint8 states to encode, ignoring the support (np.array or
+        memmap)
+        :param out: np.array or memmap in which to write the features
+        :param chunk_size: number of states encoded at once (tuned by
+        throughput if None)
+        :return: the encoded samples
+        """
+        return encode_in_chunks(
+            self.encoder.predict_on_batch,
+            lambda c, out: preprocess_states(c, binarize=self.binarize,
+                                             rows=None, out=out),
+            x, self.encoder.input_shape[1:], self.encoder.output_shape[1:],
+            out=out, chunk_size=chunk_size, tuner=self.chunk_tuner,
+            buffers=self.encode_buffers)
 
     def s_features(self, x, support=None):
         """
@@ -1,6 +1,7 @@
 from random import random, choice
 
 import joblib
+import numpy as np
 from ifqi.algorithms.fqi import FQI
 
 
@@ -61,6 +62,39 @@ class EpsilonFQI:
             return self.fqi.draw_action(preprocessed_state, absorbing,
                                         evaluation=evaluation)
 
+    def draw_actions(self, states, absorbing, evaluation=False, fully_deterministic=False):
+        """
+        Picks an action for each of the given states according to the
+        epsilon-greedy choice, encoding and scoring all the greedy states with
+        a single call to the feature extractor and to FQI (fqi.draw_action, as
+        in draw_action).
+        :param states: np.array of states
+        :param absorbing: np.array of bools, whether each state is absorbing
+        :param evaluation: bool, whether to use the epsilon defined for
+        evaluation (passed to fqi.draw_action)
+        :param fully_deterministic: whether to use FQI, deterministically, to
+        select the actions
+        :return: np.array with the selected action of each state
+        """
+        n_states = len(states)
+        actions = np.asarray(self.actions)
+        if fully_deterministic:
+            explore = np.zeros(n_states, dtype=bool)
+        else:
+            explore = np.random.random(n_states) <= self.epsilon
+        selected = np.empty(n_states, dtype=actions.dtype)
+        selected[explore] = np.random.choice(actions.ravel(), explore.sum())
+
+        greedy = ~explore
+        if greedy.any():
+            features = self.fe.s_features(np.asarray(states)[greedy])
+            features = np.reshape(features, (greedy.sum(), -1))
+            greedy_actions = self.fqi.draw_action(features,
+                                                  np.asarray(absorbing)[greedy],
+                                                  evaluation=evaluation)
+            selected[greedy] = np.ravel(greedy_actions)
+        return selected
+
     def set_epsilon(self, epsilon):
         """
         :param epsilon: the exploration rate to use 
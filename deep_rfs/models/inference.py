@@ -0,0 +1,145 @@
+import multiprocessing
+import time
+from Queue import Empty
+from random import random, choice
+
+import numpy as np
+
+
+class PolicyClient:
+    def __init__(self, client_id, requests, responses, actions, epsilon=0.05):
+        """
+        Epsilon-greedy policy that selects its greedy actions through an
+        InferenceServer (see InferenceServer.client). Random actions are drawn
+        locally, so fully random clients never wait for the server.
+        :param client_id: index of the client in the server
+        :param requests: queue of the requests to the server
+        :param responses: queue of the responses to this client
+        :param actions: the discrete actions of the policy
+        :param epsilon: exploration rate of the policy
+        """
+        self.client_id = client_id
+        self.requests = requests
+        self.responses = responses
+        self.actions = actions
+        self.epsilon = epsilon
+        self.request_id = 0
+
+    def draw_action(self, state, absorbing, evaluation=False, fully_deterministic=False):
+        """
+        Picks an action according to the epsilon-greedy choice (see
+        EpsilonFQI.draw_action), waiting for the server if the action is
+        greedy.
+        """
+        if not fully_deterministic and random() <= self.epsilon:
+            return choice(self.actions)
+        self.request_id += 1
+        self.requests.put((self.client_id, self.request_id, np.asarray(state),
+                           bool(absorbing), evaluation, time.time()))
+        request_id, action = self.responses.get()
+        assert request_id == self.request_id, 'Unexpected response'
+        return action
+
+    def set_epsilon(self, epsilon):
+        self.epsilon = epsilon
+
+    def get_epsilon(self):
+        return self.epsilon
+
+
+class InferenceServer:
+    def __init__(self, policy=None, n_clients=1, max_batch_size=32,
+                 max_delay=0.005):
+        """
+        Selects the greedy actions of several PolicyClients (e.g. used by
+        the workers of a CollectionPool) in batches, with a single copy of
+        the policy: requests are batched until max_batch_size requests are
+        waiting or max_delay seconds have passed since the first one, and
+        the actions of a batch are selected with one call to
+        policy.draw_actions.
+        The server runs in the process of the policy, when its owner calls
+        serve (so Keras models are only used by the thread that built them),
+        and the clients must be created (see client) before the processes
+        that use them are forked.
+        :param policy: the policy (e.g. EpsilonFQI; can be replaced by setting
+        self.policy)
+        :param n_clients: number of clients
+        :param max_batch_size: maximum number of states in a batch
+        :param max_delay: maximum time in seconds that the first request of a
+        batch waits for other requests
+        """
+        self.policy = policy
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.requests = multiprocessing.Queue()
+        self.responses = [multiprocessing.Queue() for _ in xrange(n_clients)]
+        self.latencies = []
+        self.batch_sizes = []
+
+    def client(self, client_id, actions, epsilon=0.05):
+        """
+        :param client_id: index of the client (0 <= client_id < n_clients)
+        :param actions: the discrete actions of the policy
+        :param epsilon: exploration rate of the client
+        :return: a PolicyClient that sends its requests to this server
+        """
+        return PolicyClient(client_id, self.requests, self.responses[client_id],
+                            actions, epsilon=epsilon)
+
+    def serve(self, timeout=None):
+        """
+        Waits for a request and serves it, batched with the requests that
+        arrive within max_delay.
+        :param timeout: maximum time in seconds to wait for the first request
+        (forever if None)
+        :return: the number of served requests (0 if none arrived)
+        """
+        try:
+            batch = [self.requests.get(timeout=timeout)]
+        except Empty:
+            return 0
+        deadline = time.time() + self.max_delay
+        while len(batch) < self.max_batch_size:
+            try:
+                batch.append(self.requests.get(timeout=max(deadline - time.time(), 0)))
+            except Empty:
+                break
+
+        # Requests for evaluation and collection are served separately
+        for evaluation in set(r[4] for r in batch):
+            requests = [r for r in batch if r[4] == evaluation]
+            states = np.concatenate([np.reshape(r[2], (-1,) + r[2].shape[-3:])
+                                     for r in requests])
+            absorbing = np.array([r[3] for r in requests])
+            actions = self.policy.draw_actions(states, absorbing,
+                                               evaluation=evaluation,
+                                               fully_deterministic=True)
+            now = time.time()
+            for (client_id, request_id, _, _, _, submitted), action in \
+                    zip(requests, actions):
+                self.responses[client_id].put((request_id, action))
+                self.latencies.append(now - submitted)
+        self.batch_sizes.append(len(batch))
+        return len(batch)
+
+    def stats(self, reset=False):
+        """
+        :param reset: whether to clear the metrics
+        :return: dict with the number of served requests and batches, the mean
+        batch size, and the mean, median, 95th and 99th percentile and maximum
+        latency of the requests in milliseconds (from the submission of the
+        request to its response)
+        """
+        latencies = np.array(self.latencies) * 1000
+        stats = {'requests': len(latencies),
+                 'batches': len(self.batch_sizes),
+                 'batch_size': np.mean(self.batch_sizes) if self.batch_sizes else 0.}
+        if len(latencies) > 0:
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            stats.update({'latency_mean': latencies.mean(),
+                          'latency_p50': p50, 'latency_p95': p95,
+                          'latency_p99': p99, 'latency_max': latencies.max()})
+        if reset:
+            self.latencies = []
+            self.batch_sizes = []
+        return stats
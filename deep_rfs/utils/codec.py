@@ -0,0 +1,101 @@
+import multiprocessing
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+
+try:
+    import lzma
+except ImportError:  # Not in the standard library of Python 2
+    lzma = None
+
+CODECS = ('zlib', 'lzma')
+
+
+def _check_codec(codec):
+    if codec not in CODECS:
+        raise ValueError('Unknown codec %s (allowed: %s)' % (codec, ', '.join(CODECS)))
+    if codec == 'lzma' and lzma is None:
+        raise ImportError('The lzma module is not available, use codec \'zlib\'')
+
+
+def _compress(data, codec, level):
+    if codec == 'zlib':
+        return zlib.compress(data, level)
+    else:
+        return lzma.compress(data, preset=level)
+
+
+def _decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    else:
+        return lzma.decompress(data)
+
+
+def encode_frames(frames, codec='zlib', level=6, chunk_size=256):
+    """
+    Compresses a sequence of uint8 frames in independent chunks. Each frame in
+    a chunk is stored as its difference (mod 256) from the previous frame, so
+    that the mostly static background of consecutive Atari frames becomes
+    runs of zeros.
+    :param frames: np.array of shape (n_frames, rows, cols), uint8
+    :param codec: compression algorithm ('zlib' or 'lzma')
+    :param level: compression level (preset for lzma)
+    :param chunk_size: number of frames in a chunk
+    :return: (data, offsets), the compressed chunks as a single string and the
+    np.array with the offset of each chunk in data (plus the total length)
+    """
+    _check_codec(codec)
+    chunks = []
+    offsets = [0]
+    for start in range(0, len(frames), chunk_size):
+        chunk = np.asarray(frames[start:start + chunk_size], dtype=np.uint8)
+        delta = chunk.copy()
+        delta[1:] -= chunk[:-1]
+        chunks.append(_compress(delta.tobytes(), codec, level))
+        offsets.append(offsets[-1] + len(chunks[-1]))
+    return b''.join(chunks), np.array(offsets, dtype=np.int64)
+
+
+def decode_frames(data, offsets, n_frames, frame_shape, codec='zlib',
+                  chunk_size=256, n_threads=None):
+    """
+    Decompresses frames encoded with encode_frames, decoding chunks in
+    parallel (zlib and lzma release the GIL while decompressing).
+    :param data: the compressed chunks as a single string
+    :param offsets: np.array with the offset of each chunk in data
+    :param n_frames: total number of frames
+    :param frame_shape: shape of a frame
+    :param codec: compression algorithm used to encode the frames
+    :param chunk_size: number of frames in a chunk
+    :param n_threads: number of decoding threads (all cores if None)
+    :return: np.array of shape (n_frames, rows, cols), uint8
+    """
+    _check_codec(codec)
+    frame_shape = tuple(frame_shape)
+    frames = np.empty((n_frames,) + frame_shape, dtype=np.uint8)
+    n_chunks = len(offsets) - 1
+
+    def decode_chunk(i):
+        raw = _decompress(data[offsets[i]:offsets[i + 1]], codec)
+        delta = np.frombuffer(raw, dtype=np.uint8).reshape((-1,) + frame_shape)
+        start = i * chunk_size
+        np.cumsum(delta, axis=0, dtype=np.uint8,
+                  out=frames[start:start + len(delta)])
+
+    if n_threads is None:
+        n_threads = multiprocessing.cpu_count()
+    n_threads = max(1, min(n_threads, n_chunks))
+    if n_threads == 1:
+        for i in range(n_chunks):
+            decode_chunk(i)
+    else:
+        pool = ThreadPool(n_threads)
+        try:
+            pool.map(decode_chunk, range(n_chunks))
+        finally:
+            pool.close()
+            pool.join()
+
+    return frames
@@ -0,0 +1,200 @@
+import multiprocessing
+import os
+import random
+
+import numpy as np
+from tqdm import tqdm
+
+from deep_rfs.utils.datasets import episode
+from deep_rfs.utils.framestore import ShardWriter
+from deep_rfs.utils.manifest import add_summaries
+
+# State of the current worker process (see _init_worker)
+_worker = {}
+
+
+class RandomPolicy:
+    def __init__(self, actions):
+        """
+        Fully random policy, used by the workers of a CollectionPool to
+        collect with epsilon = 1 without loading the feature extractor.
+        :param actions: the discrete actions of the environment
+        """
+        self.actions = actions
+
+    def draw_action(self, state, absorbing, evaluation=False):
+        return random.choice(self.actions)
+
+
+def _init_worker(make_env, make_policy, clients=None, counter=None):
+    # Forked workers would otherwise draw the same random numbers
+    np.random.seed()
+    random.seed()
+    _worker['env'] = make_env()
+    _worker['make_policy'] = make_policy
+    _worker['policy'] = None
+    _worker['version'] = None
+    _worker['client'] = None
+    if clients is not None:
+        # Each worker takes its own client of the inference server
+        with counter.get_lock():
+            _worker['client'] = clients[counter.value]
+            counter.value += 1
+
+
+def _worker_policy(update, epsilon):
+    if epsilon >= 1:
+        return RandomPolicy(list(_worker['env'].action_space.values))
+    if _worker['client'] is not None:
+        _worker['client'].set_epsilon(epsilon)
+        return _worker['client']
+
+    version, fqi, weights, support = update
+    if _worker['version'] != version:
+        if _worker['policy'] is None:
+            _worker['policy'] = _worker['make_policy'](fqi)
+        elif fqi is not None:
+            _worker['policy'].load_fqi(fqi)
+        if weights is not None:
+            _worker['policy'].fe.load(weights)
+        if support is not None:
+            _worker['policy'].fe.set_support(support)
+        _worker['version'] = version
+    _worker['policy'].set_epsilon(epsilon)
+    return _worker['policy']
+
+
+def _collect_shard(task):
+    path, block, samples, random_samples, epsilon, update, kwargs = task
+    env = _worker['env']
+    # Shards hold at most shard_size episodes, so their episode ids are unique
+    writer = ShardWriter(path, samples, base_block=block,
+                         history=env.state_shape[0],
+                         shuffle=kwargs['shuffle'], codec=kwargs['codec'],
+                         binarization_threshold=kwargs['binarization_threshold'],
+                         base_episode=block * kwargs['shard_size'],
+                         update_manifest=False)
+    while writer.nb_samples < samples:
+        policy = _worker_policy(update, 1 if writer.nb_samples < random_samples else epsilon)
+        for transition in episode(env, policy,
+                                  initial_actions=kwargs['initial_actions'],
+                                  repeat=kwargs['repeat']):
+            writer.append(*transition)
+            if writer.nb_samples == samples:
+                break
+        writer.end_episode()
+    writer.close()
+    return writer.summaries
+
+
+class CollectionPool:
+    def __init__(self, make_env, make_policy=None, n_workers=None,
+                 server=None, actions=None):
+        """
+        Pool of processes that collect SARS' shards in parallel. Each worker
+        builds its own environment once, and its own policy only when it first
+        collects with epsilon < 1 (fully random shards never load the feature
+        extractor). Policies are updated by sending the paths of the new
+        weights to the workers (see update_policy), and the workers save the
+        shards to disk themselves, so that neither environments, models nor
+        transitions are pickled.
+        The pool should be created before any Keras model is built, since the
+        workers are forked from the current process.
+        :param make_env: callable that returns a new environment (e.g.
+        functools.partial(Atari, name))
+        :param make_policy: callable that returns a new policy (e.g. an
+        EpsilonFQI) given the path of the FQI to load
+        :param n_workers: number of processes (all cores if None)
+        :param server: an InferenceServer with a client for each worker, to
+        select the greedy actions of the workers in batches with the policy of
+        the server instead of make_policy (the server is run by
+        collect_to_disk)
+        :param actions: the discrete actions of the policy (required with a
+        server)
+        """
+        if n_workers is None:
+            n_workers = multiprocessing.cpu_count()
+        if server is not None:
+            clients = [server.client(i, actions) for i in xrange(n_workers)]
+            counter = multiprocessing.Value('i', 0)
+        else:
+            clients = counter = None
+        self.server = server
+        self.pool = multiprocessing.Pool(n_workers, initializer=_init_worker,
+                                         initargs=(make_env, make_policy,
+                                                   clients, counter))
+        self.update = (0, None, None, None)
+
+    def update_policy(self, fqi=None, weights=None, support=None):
+        """
+        Sets the policy used by the workers for the next collections.
+        :param fqi: path of the FQI to load (see EpsilonFQI.save_fqi)
+        :param weights: path of the weights of the feature extractor to load
+        (see Autoencoder.load)
+        :param support: support of the feature extractor
+        """
+        self.update = (self.update[0] + 1, fqi, weights, support)
+
+    def collect_to_disk(self, path, samples, blocks, base_block=0,
+                        random_samples=0, epsilon=1, history=4,
+                        initial_actions=None, repeat=1, shuffle=False,
+                        codec=None, binarization_threshold=None):
+        """
+        Collects `samples` SARS' transitions to `blocks` shards of equal size
+        in path (see deep_rfs.utils.datasets.collect_sars_to_disk). Each shard
+        is collected by a single worker, so episodes do not span shards and
+        the last episode of each shard is truncated.
+        :param path: folder in which to save the shards
+        :param samples: number of transitions to collect
+        :param blocks: number of shards
+        :param base_block: index of the first shard
+        :param random_samples: number of transitions collected with a fully
+        random policy (the first ones of each shard, in order of shards)
+        :param epsilon: exploration rate of the policy for the other
+        transitions
+        :param history: number of frames in a state
+        :return: the number of collected samples
+        """
+        if not path.endswith('/'):
+            path += '/'
+        if not os.path.exists(path):
+            os.makedirs(path)
+        shard_size = int(np.ceil(samples / float(blocks)))
+        kwargs = {'shard_size': shard_size,
+                  'initial_actions': initial_actions, 'repeat': repeat,
+                  'shuffle': shuffle, 'codec': codec,
+                  'binarization_threshold': binarization_threshold}
+        tasks = []
+        for b in xrange(blocks):
+            start = b * shard_size
+            size = min(shard_size, samples - start)
+            if size <= 0:
+                break
+            tasks.append((path, base_block + b, size,
+                          min(max(random_samples - start, 0), size), epsilon,
+                          self.update, kwargs))
+
+        summaries = []
+        results = self.pool.imap_unordered(_collect_shard, tasks)
+        progress = tqdm(total=len(tasks))
+        while progress.n < len(tasks):
+            if self.server is None:
+                summaries.extend(results.next())
+            else:
+                # Serve the workers while waiting for the shards
+                try:
+                    summaries.extend(results.next(timeout=0))
+                except multiprocessing.TimeoutError:
+                    self.server.serve(timeout=0.01)
+                    continue
+            progress.update(1)
+        progress.close()
+        add_summaries(path, summaries, history)
+        return sum(s['rows'] for s in summaries)
+
+    def close(self):
+        """
+        Stops the workers.
+        """
+        self.pool.close()
+        self.pool.join()
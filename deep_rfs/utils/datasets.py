@@ -1,18 +1,29 @@
 import glob
 import os
+import threading
+import weakref
 
 import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from tqdm import tqdm
 
-from deep_rfs.utils.helpers import flat2list, pds_to_npa
+from deep_rfs.envs.vector import VectorEnv, vector_episodes
+from deep_rfs.utils.feature_cache import encoder_key
+from deep_rfs.utils.framestore import EpisodeRecorder, FrameStore, \
+    LazyStores, ShardWriter
+from deep_rfs.utils.manifest import INDEX, block_number, load_manifest, \
+    save_manifest, shard_path, summarize, total_counts
+from deep_rfs.utils.pipeline import prefetch
 
 
 # DATASET BUILDERS
 def episode(mdp, policy, video=False, initial_actions=None, repeat=1):
     """
-    Collects an episode of the given MDP using the given policy.
+    Generator of the SARS' transitions of an episode of the given MDP, collected
+    using the given policy.
+    Transitions are yielded in terms of the frames observed by the agent, so
+    that each frame is yielded exactly once.
 
     Args
         mdp (Object): an mdp object (e.g. deep_rfs.envs.atari.Atari).
@@ -21,44 +32,59 @@ def episode(mdp, policy, video=False, initial_actions=None, repeat=1):
         video (bool, False): render the video of the episode.
         initial_actions (list, None): list of action indices that start an
             episode of the MDP.
+        repeat (int, 1): number of times each action is repeated, observing
+            all the intermediate frames (the repeat of
+            deep_rfs.envs.atari.Atari observes only the last one, so it does
+            not preprocess the others).
 
-    Return
-        A sequence of SARS' transitions as np.array
+    Yield
+        (frames, A, R, next_frames, DONE): the frames observed before the
+            transition (the last one is the most recent frame of S), the
+            action, the reward, the frames observed while executing the action
+            (the last one is the most recent frame of S') and the absorbing
+            flag.
     """
     frame_counter = 0
 
     # Get current state
     state = mdp.reset()
+    frames = [np.array(frame) for frame in state]
 
     # Force start
     if initial_actions is not None:
         action = np.random.choice(initial_actions)
         state, _, _, info = mdp.step(action)
+        frames.append(np.array(state[-1]))
         lives_count = info['ale.lives']
 
+    # Lives are tracked through the info of the steps
+    lives = mdp.env.env.ale.lives()
     reward = 0
     done = False
 
     # Start episode
-    ep_output = []
     while not done:
         frame_counter += 1
 
         if initial_actions is not None:
             if info['ale.lives'] < lives_count:
                 lives_count = info['ale.lives']
-                state, _, _, _ = mdp.step(np.random.choice(initial_actions))
+                state, _, _, info = mdp.step(np.random.choice(initial_actions))
+                frames.append(np.array(state[-1]))
+                lives = info['ale.lives']
 
         # Select and execute the action, get next state and reward
         action = policy.draw_action(np.expand_dims(state, 0), done)
         action = int(action)
         # Repeat action
+        next_frames = []
         temp_reward = 0
         temp_done = False  # Used to break out of repeat
         for _ in range(repeat):
-            lives = mdp.env.env.ale.lives()
             next_state, reward, done, info = mdp.step(action)
+            next_frames.append(np.array(next_state[-1]))
             life_lost = (not lives == info['ale.lives'])
+            lives = info['ale.lives']
             temp_reward += reward
             temp_done = temp_done or done
             if temp_done:
@@ -66,8 +92,9 @@ def episode(mdp, policy, video=False, initial_actions=None, repeat=1):
         reward = temp_reward
         done = temp_done
 
-        # build SARS' tuple
-        ep_output.append([state, action, reward, next_state, (done or life_lost)])
+        # SARS' transition
+        yield frames, action, reward, next_frames, (done or life_lost)
+        frames = []
 
         # Render environment
         if video:
@@ -76,7 +103,46 @@ def episode(mdp, policy, video=False, initial_actions=None, repeat=1):
         # Update state
         state = next_state
 
-    return ep_output
+
+def record_episode(mdp, policy, video=False, initial_actions=None, repeat=1):
+    """
+    Collects an episode of the given MDP using the given policy (see episode).
+
+    Return
+        The SARS' transitions of the episode as a FrameStore
+    """
+    recorder = EpisodeRecorder(history=mdp.state_shape[0])
+    for transition in episode(mdp, policy, video=video,
+                              initial_actions=initial_actions, repeat=repeat):
+        recorder.append(*transition)
+    return recorder.to_store()
+
+
+def record_vector_episodes(venv, policy, episodes, initial_actions=None,
+                           repeat=1):
+    """
+    Collects episodes on the environments of a VectorEnv in lockstep, selecting
+    the actions of all environments with a single call to policy.draw_actions
+    (see deep_rfs.envs.vector.vector_episodes).
+
+    Return
+        The list of the SARS' transitions of each episode as a FrameStore, in
+        the order in which the episodes were started
+    """
+    recorders = {}
+    stores = [None] * episodes
+    progress = tqdm(total=episodes)
+    for episode_id, transition, end in vector_episodes(
+            venv, policy, episodes, initial_actions=initial_actions,
+            repeat=repeat):
+        if episode_id not in recorders:
+            recorders[episode_id] = EpisodeRecorder(history=venv.state_shape[0])
+        recorders[episode_id].append(*transition)
+        if end:
+            stores[episode_id] = recorders.pop(episode_id).to_store()
+            progress.update(1)
+    progress.close()
+    return stores
 
 
 def collect_sars(mdp, policy, episodes=100, n_jobs=1, random_episodes_pctg=0.0,
@@ -88,12 +154,15 @@ def collect_sars(mdp, policy, episodes=100, n_jobs=1, random_episodes_pctg=0.0,
     random policy, whereas the remaining part is collected with a greedy policy.
 
     Args
-        mdp (Object): an mdp object (e.g. deep_rfs.envs.atari.Atari).
+        mdp (Object): an mdp object (e.g. deep_rfs.envs.atari.Atari), or a
+            deep_rfs.envs.vector.VectorEnv to run its environments in
+            lockstep and select their actions in batches.
         policy (Object): a policy object (e.g. deep_rfs.models.EpsilonFQI).
-            Methods draw_action and set_epsilon are expected.
+            Methods draw_action (draw_actions with a VectorEnv) and
+            set_epsilon are expected.
         episodes (int, 100): number of episodes to collect.
         n_jobs (int, 1): number of processes to use (-1 for all available cores).
-            Leave 1 if running stuff on GPU.
+            Leave 1 if running stuff on GPU. Unused with a VectorEnv.
         random_greedy_split (float, 0.9): percentage of random episodes to
             collect.
         debug (bool, False): collect the episodes in debug mode (only a very
@@ -104,48 +173,53 @@ def collect_sars(mdp, policy, episodes=100, n_jobs=1, random_episodes_pctg=0.0,
             it.
 
     Return
-        A SARS' dataset as pd.DataFrame with columns 'S', 'A', 'R', 'SS', 'DONE'
+        A SARS' dataset as FrameStore, or as pd.DataFrame with columns 'S', 'A',
+        'R', 'SS', 'DONE' if return_dataframe is True
     """
     random_episodes = int(episodes * random_episodes_pctg)
     greedy_episodes = episodes - random_episodes
 
     old_epsilon = policy.get_epsilon()
-    policy.set_epsilon(1)
-    dataset_random = Parallel(n_jobs=n_jobs)(
-        delayed(episode)(mdp, policy, initial_actions=initial_actions,
-                         repeat=repeat)
-        for _ in tqdm(xrange(random_episodes))
-    )
-    # Each episode is in a list, so the dataset needs to be flattened
-    dataset_random = np.asarray(flat2list(dataset_random))
-
-    policy.set_epsilon(old_epsilon)
-    dataset_greedy = Parallel(n_jobs=n_jobs)(
-        delayed(episode)(mdp, policy, initial_actions=initial_actions,
-                         repeat=repeat)
-        for _ in tqdm(xrange(greedy_episodes))
-    )
-    # Each episode is in a list, so the dataset needs to be flattened
-    dataset_greedy = np.asarray(flat2list(dataset_greedy))
-
-    if len(dataset_greedy) != 0 and len(dataset_random) != 0:
-        dataset = np.append(dataset_random, dataset_greedy, 0)
-    elif len(dataset_greedy) != 0:
-        dataset = dataset_greedy
+    if isinstance(mdp, VectorEnv):
+        policy.set_epsilon(1)
+        dataset_random = record_vector_episodes(
+            mdp, policy, random_episodes, initial_actions=initial_actions,
+            repeat=repeat)
+        policy.set_epsilon(old_epsilon)
+        dataset_greedy = record_vector_episodes(
+            mdp, policy, greedy_episodes, initial_actions=initial_actions,
+            repeat=repeat)
     else:
-        dataset = dataset_random
+        policy.set_epsilon(1)
+        dataset_random = Parallel(n_jobs=n_jobs)(
+            delayed(record_episode)(mdp, policy, initial_actions=initial_actions,
+                                    repeat=repeat)
+            for _ in tqdm(xrange(random_episodes))
+        )
+
+        policy.set_epsilon(old_epsilon)
+        dataset_greedy = Parallel(n_jobs=n_jobs)(
+            delayed(record_episode)(mdp, policy, initial_actions=initial_actions,
+                                    repeat=repeat)
+            for _ in tqdm(xrange(greedy_episodes))
+        )
+
+    # Each episode is in its own store, so the episodes need to be joined
+    dataset = FrameStore.concatenate(list(dataset_random) + list(dataset_greedy))
 
     if shuffle:
-        np.random.shuffle(dataset)
+        dataset = dataset.take(np.random.permutation(len(dataset)))
 
     # TODO debug
     if debug:
-        dataset = dataset[:7]
-        dataset[:2, 2] = 1.0
+        dataset = dataset.take(np.arange(min(7, len(dataset))))
+        dataset.r[:2] = 1.0
 
     if return_dataframe:
-        header = ['S', 'A', 'R', 'SS', 'DONE']
-        return pd.DataFrame(dataset, columns=header)
+        return pd.DataFrame({'S': list(dataset.S()), 'A': dataset.a,
+                             'R': dataset.r, 'SS': list(dataset.SS()),
+                             'DONE': dataset.done},
+                            columns=['S', 'A', 'R', 'SS', 'DONE'])
     else:
         return dataset
 
@@ -153,195 +227,914 @@ def collect_sars(mdp, policy, episodes=100, n_jobs=1, random_episodes_pctg=0.0,
 def collect_sars_to_disk(mdp, policy, path, samples, blocks, base_block=0,
                          n_jobs=1, random_episodes_pctg=0.0, debug=False,
                          initial_actions=None, shuffle=False, repeat=1,
-                         batch_size=None):
+                         batch_size=None, codec=None,
+                         binarization_threshold=None, pool=None):
+    """
+    Collects exactly `samples` SARS' transitions of the given MDP and streams
+    them to `blocks` FrameStore shards of equal size in path ('sars_<i>/'
+    folders, with i starting from base_block). The last episode is truncated
+    when the target number of samples is reached.
+    The first random_episodes_pctg of the samples is collected with a fully
+    random policy, the rest with the given policy.
+
+    Args
+        mdp (Object): an mdp object (e.g. deep_rfs.envs.atari.Atari).
+        policy (Object): a policy object (e.g. deep_rfs.models.EpsilonFQI).
+        path (str): folder in which to save the shards.
+        samples (int): number of transitions to collect.
+        blocks (int): number of shards in which to split the transitions.
+        base_block (int, 0): index of the first shard.
+        n_jobs (int, 1): unused, transitions are streamed from a single
+            environment (see pool).
+        shuffle (bool, False): shuffle the transitions of each shard.
+        codec (str, None): compress the frames of each shard with the given
+            codec ('zlib' or 'lzma').
+        binarization_threshold (float, None): if given, binarize the frames
+            with this threshold and store them as bits (see FrameStore.pack).
+        pool (CollectionPool, None): if given, collect the shards in parallel
+            on the environments of the workers of the pool, with the policy
+            of its last update and the current epsilon of policy (mdp is
+            unused, and episodes do not span shards).
+
+    Return
+        The number of collected samples
+    """
+    if debug:
+        samples = min(samples, 7 * blocks)
+    if pool is not None:
+        nb_samples = pool.collect_to_disk(
+            path, samples, blocks, base_block=base_block,
+            random_samples=int(samples * random_episodes_pctg),
+            epsilon=policy.get_epsilon(), history=mdp.state_shape[0],
+            initial_actions=initial_actions, repeat=repeat, shuffle=shuffle,
+            codec=codec, binarization_threshold=binarization_threshold)
+        build_index(path)
+        return nb_samples
+
+    shard_size = int(np.ceil(samples / float(blocks)))
+    random_samples = int(samples * random_episodes_pctg)
+    writer = ShardWriter(path, shard_size, base_block=base_block,
+                         history=mdp.state_shape[0], shuffle=shuffle,
+                         codec=codec,
+                         binarization_threshold=binarization_threshold)
+
+    old_epsilon = policy.get_epsilon()
+    progress = tqdm(total=samples)
+    while writer.nb_samples < samples:
+        policy.set_epsilon(1 if writer.nb_samples < random_samples else old_epsilon)
+        for transition in episode(mdp, policy, initial_actions=initial_actions,
+                                  repeat=repeat):
+            writer.append(*transition)
+            progress.update(1)
+            if writer.nb_samples == samples:
+                break
+        writer.end_episode()
+    writer.close()
+    progress.close()
+    policy.set_epsilon(old_epsilon)
+    build_index(path)
+
+    return writer.nb_samples
+
+
+def build_manifest(path):
+    """
+    Writes the manifest of the dataset in path by reading all 'sars_*' stores
+    (e.g. for datasets collected before manifests were introduced).
+    Raises a ValueError if the dataset only has legacy 'sars_*.npy' files,
+    which must be converted with convert_legacy_sars first.
+
+    Return
+        The manifest as a dict
+    """
+    if not path.endswith('/'):
+        path += '/'
+    names = [os.path.basename(f) for f in glob.glob(path + 'sars_*')
+             if os.path.isdir(f)]
+    if len(names) == 0 and len(glob.glob(path + 'sars_*.npy')) > 0:
+        raise ValueError('%s only has legacy sars_*.npy files, convert them '
+                         'with deep_rfs.utils.datasets.convert_legacy_sars' % path)
+    names.sort(key=block_number)
+    manifest = {'history': 4, 'shards': []}
+    for n in names:
+        store = FrameStore.load(path + n)
+        manifest['history'] = store.history
+        manifest['shards'].append(summarize(store, n))
+    save_manifest(path, manifest)
+    return manifest
+
+
+def get_manifest(path):
+    """
+    Returns the manifest of the dataset in path (as collected with
+    collect_sars_to_disk), building it if the dataset does not have one.
+    """
+    manifest = load_manifest(path)
+    if manifest is None or len(manifest['shards']) == 0:
+        # Empty manifests are rebuilt (e.g. saved for a legacy dataset)
+        manifest = build_manifest(path)
+    return manifest
+
+
+def get_sars_files(path):
+    """
+    Returns the list of SARS' frame stores saved in path (as collected with
+    collect_sars_to_disk), in the order given by the manifest.
+    """
+    if not path.endswith('/'):
+        path += '/'
+    files = [shard_path(path, shard) for shard in get_manifest(path)['shards']]
+    print 'Got %s files' % len(files)
+    return files
+
+
+# Fields of the transition index of a dataset
+INDEX_DTYPE = [('block', np.int32), ('row', np.int32), ('r', np.float32),
+               ('a', np.int32), ('done', np.bool_), ('episode', np.int32)]
+
+
+def build_index(path):
+    """
+    Writes the transition index of the dataset in path: a compact array with
+    the shard (block number), row, reward, action, absorbing flag and episode
+    id of each transition, in the order of the manifest, so that subsets of
+    transitions can be selected without loading the shards.
+
+    Return
+        The index as np.array with fields INDEX_DTYPE
+    """
+    if not path.endswith('/'):
+        path += '/'
+    shards = get_manifest(path)['shards']
+    index = np.empty(sum(shard['rows'] for shard in shards), dtype=INDEX_DTYPE)
+    start = 0
+    for shard in shards:
+        store = FrameStore.load(shard_path(path, shard), load_frames=False)
+        stop = start + len(store)
+        index['block'][start:stop] = block_number(shard['name'])
+        index['row'][start:stop] = np.arange(len(store))
+        index['r'][start:stop] = store.r
+        index['a'][start:stop] = store.a
+        index['done'][start:stop] = store.done
+        index['episode'][start:stop] = store.episode
+        start = stop
+    np.save(path + INDEX, index)
+    return index
+
+
+def get_index(path):
+    """
+    Returns the transition index of the dataset in path (see build_index),
+    building it if the dataset does not have one or if its shards have
+    changed (e.g. after aggregate_sars).
+    """
+    if not path.endswith('/'):
+        path += '/'
+    if os.path.exists(path + INDEX):
+        index = np.load(path + INDEX, mmap_mode='r')
+        shards = get_manifest(path)['shards']
+        blocks = np.unique(index['block'])
+        if len(index) == sum(shard['rows'] for shard in shards) and \
+                np.array_equal(blocks, sorted(block_number(shard['name']) for shard in shards)):
+            return index
+    return build_index(path)
+
+
+def next_block(path):
+    """
+    Returns the first free block number of the dataset in path (0 if it does
+    not exist), e.g. to pass as base_block to collect_sars_to_disk so that
+    the shards of several collections have distinct names.
+    """
+    manifest = load_manifest(path)
+    if manifest is None or len(manifest['shards']) == 0:
+        return 0
+    return max(block_number(shard['name']) for shard in manifest['shards']) + 1
+
+
+def aggregate_sars(path, sources, max_samples=None, eviction='reservoir',
+                   recency=1.):
+    """
+    Adds the shards of the datasets in sources to the aggregated dataset in
+    path, which only holds a manifest referencing the shards in their
+    original folders, so that it can be passed to the generators and builders
+    like any other dataset.
+    When the aggregated dataset holds more than max_samples transitions,
+    shards are dropped from it (but not deleted from their original folder):
+        'fifo': the oldest shards are dropped first;
+        'reservoir': each shard is given a random priority when added, and
+            the shards with the lowest priority are dropped first (weighted
+            reservoir sampling), so that the kept shards are a uniform
+            sample of all the shards ever added when recency is 1, and
+            shards added by later calls are more likely to be kept when
+            recency > 1 (their weight is recency ** number_of_calls).
+
+    Args
+        path (str): folder of the aggregated dataset.
+        sources (list): folders of the datasets to add (as collected with
+            collect_sars_to_disk).
+        max_samples (int, None): number of transitions to keep (unbounded if
+            None).
+        eviction (str, 'reservoir'): 'fifo' or 'reservoir'.
+        recency (float, 1.): weight of newer shards for reservoir eviction.
+
+    Return
+        The number of transitions in the aggregated dataset
+    """
+    if eviction not in ('fifo', 'reservoir'):
+        raise ValueError('Unknown eviction %s (allowed: fifo, reservoir)' % eviction)
     if not path.endswith('/'):
         path += '/'
     if not os.path.exists(path):
-        os.mkdir(path)
+        os.makedirs(path)
+
+    manifest = load_manifest(path) or {'history': 4, 'shards': [],
+                                       'generation': 0}
+    generation = manifest.get('generation', 0)
+    block = next_block(path)
+    for source in sources:
+        source_manifest = get_manifest(source)
+        manifest['history'] = source_manifest['history']
+        for shard in source_manifest['shards']:
+            shard = dict(shard)
+            shard['source'] = os.path.abspath(shard_path(source, shard))
+            shard['name'] = 'sars_%s' % block
+            shard['generation'] = generation
+            # log(u) / w, the log of the priority u ** (1 / w)
+            shard['priority'] = np.log(np.random.rand()) / recency ** generation
+            manifest['shards'].append(shard)
+            block += 1
+    manifest['generation'] = generation + 1
+
+    shards = manifest['shards']
+    nb_samples = sum(shard['rows'] for shard in shards)
+    if max_samples is not None:
+        if eviction == 'fifo':
+            candidates = sorted(shards, key=lambda s: block_number(s['name']))
+        else:
+            candidates = sorted(shards, key=lambda s: s['priority'])
+        for shard in candidates:
+            if nb_samples <= max_samples:
+                break
+            shards.remove(shard)
+            nb_samples -= shard['rows']
+    manifest['shards'] = shards
 
-    test_sars = collect_sars(mdp, policy, episodes=10, n_jobs=n_jobs,
-                             random_episodes_pctg=random_episodes_pctg,
-                             debug=debug, initial_actions=initial_actions,
-                             shuffle=shuffle, repeat=repeat)
-    avg_episode_lenght = np.round(len(test_sars) / 10.).astype(float)
-    episodes_in_block = int((samples / avg_episode_lenght) / blocks)
+    save_manifest(path, manifest)
+    return nb_samples
 
-    samples_in_dataset = 0
-    for i in range(base_block, base_block + blocks):
-        sars = collect_sars(mdp, policy, episodes=episodes_in_block, n_jobs=n_jobs,
-                            random_episodes_pctg=random_episodes_pctg,
-                            debug=debug, initial_actions=initial_actions,
-                            shuffle=shuffle, repeat=repeat)
 
-        samples_in_dataset += len(sars)
-        np.save(path + 'sars_%s.npy' % i, sars)
+def convert_legacy_sars(path):
+    """
+    Converts the legacy 'sars_*.npy' object arrays saved in path to
+    FrameStore folders. Frames are deduplicated when S' of a transition is
+    S of the following one, and episode ids are inferred from this continuity.
+    """
+    if not path.endswith('/'):
+        path += '/'
+    files = glob.glob(path + 'sars_*.npy')
+    print 'Got %s files' % len(files)
+
+    for f in files:
+        sars = np.load(f, allow_pickle=True)
+        recorder = EpisodeRecorder(history=len(sars[0, 0]))
+        episode_id = -1
+        last_ss = None
+        for state, action, reward, next_state, done in sars:
+            if last_ss is None or not np.array_equal(state, last_ss):
+                # S does not follow the previous S': start a new episode
+                episode_id += 1
+                frames = list(state)
+            else:
+                frames = []
+            if np.array_equal(next_state[:-1], state[1:]):
+                next_frames = [next_state[-1]]
+            else:
+                next_frames = list(next_state)
+            recorder.append(frames, action, reward, next_frames, done,
+                            episode_id=episode_id)
+            last_ss = next_state
+
+        recorder.to_store().save(f[:-len('.npy')] + '/')
+
+    build_manifest(path)
+
+
+def split_batch(stores, store_idx, rows):
+    """
+    Splits a batch of transitions by store, sorting the rows of each store
+    (so that each store is read in row order).
+
+    Args
+        stores (list): list of FrameStore.
+        store_idx (np.array): index in stores of each transition.
+        rows (np.array): row of each transition in its store.
+
+    Return
+        A list of (FrameStore, np.array) segments
+    """
+    sort = np.lexsort((rows, store_idx))
+    store_idx = store_idx[sort]
+    rows = rows[sort]
+    splits = np.flatnonzero(np.diff(store_idx)) + 1
+    return [(stores[k[0]], r) for k, r in zip(np.split(store_idx, splits),
+                                              np.split(rows, splits))]
+
+
+def shard_group_size(files, shuffle=False, shuffle_buffer=None):
+    """
+    Returns the number of frame stores in files that are visited together
+    when batching them (see batch_segments).
+    """
+    if not shuffle:
+        return 1
+    elif shuffle_buffer is not None:
+        return shuffle_buffer
+    elif any(FrameStore.info(f).get('codec') is not None for f in files):
+        return 2
+    return len(files)
+
+
+def batch_segments(files, batch_size=32, shuffle=False, shuffle_buffer=None):
+    """
+    Generator of batches of transitions from the frame stores in files.
+    Stores are visited in groups: with shuffle=True, each epoch draws a random
+    permutation of all transitions in a group, and batches are gathered from
+    the (memory-mapped) stores without copying them. By default the group is
+    the whole dataset, i.e. the permutation is global, unless the stores are
+    compressed (and thus decoded in memory): in that case, or if
+    shuffle_buffer is given, stores are visited in random order in groups of
+    shuffle_buffer stores.
+    A batch can span several stores, so each batch is a list of (store, rows)
+    segments.
+
+    Args
+        files (list): paths of the frame stores.
+        batch_size (int, 32): number of transitions in a batch.
+        shuffle (bool, False): shuffle the transitions at each epoch.
+        shuffle_buffer (int, None): number of stores that are shuffled
+            together.
+
+    Yield
+        segments (list): list of (FrameStore, np.array) tuples with the rows of
+            each store that belong to the batch.
+    """
+    group_size = shard_group_size(files, shuffle=shuffle,
+                                  shuffle_buffer=shuffle_buffer)
+    segments = []
+    nb_rows = 0
+    while True:
+        order = np.random.permutation(len(files)) if shuffle else np.arange(len(files))
+        for g in range(0, len(files), group_size):
+            stores = [FrameStore.load(files[i]) for i in order[g:g + group_size]]
+            offsets = np.cumsum([0] + [len(store) for store in stores])
+            if shuffle:
+                indices = np.random.permutation(offsets[-1])
+            else:
+                indices = np.arange(offsets[-1])
+            store_idx = np.searchsorted(offsets, indices, side='right') - 1
+            rows = indices - offsets[store_idx]
+
+            start = 0
+            while start < len(indices):
+                stop = min(start + batch_size - nb_rows, len(indices))
+                segments += split_batch(stores, store_idx[start:stop],
+                                        rows[start:stop])
+                nb_rows += stop - start
+                start = stop
+                if nb_rows == batch_size:
+                    yield segments
+                    segments = []
+                    nb_rows = 0
+
+
+def reward_classes(index, clip=False):
+    """
+    Returns the reward class of each transition of a transition index (its
+    reward, clipped to [-1, 1] if clip is True).
+    """
+    r = np.asarray(index['r'])
+    return np.clip(r, -1, 1) if clip else r
+
+
+def stratified_allocation(index, epoch_size, clip=False):
+    """
+    Splits the transitions of a stratified epoch equally among the reward
+    classes of a transition index.
+
+    Return
+        (classes, allocation, importance): the reward classes, the number of
+        transitions drawn from each class in an epoch, and the importance
+        weight of the transitions of each class, i.e. the ratio between the
+        frequency of the class in the dataset and in an epoch (so that the
+        weighted loss of an epoch is an unbiased estimate of the loss on the
+        whole dataset).
+    """
+    classes, counts = np.unique(reward_classes(index, clip=clip),
+                                return_counts=True)
+    allocation = np.full(len(classes), epoch_size // len(classes))
+    allocation[:epoch_size % len(classes)] += 1
+    importance = (counts / float(counts.sum())) / (allocation / float(epoch_size))
+    return classes, allocation, importance
+
+
+def index_stores(path, max_decoded=None):
+    """
+    Maps the transition index of the dataset in path to its frame stores,
+    which are loaded when first accessed (see LazyStores).
+
+    Args
+        path (str): path to folder containing 'sars_*' frame stores (as collected
+            with collect_sars_to_disk)
+        max_decoded (int, None): number of compressed stores kept decoded in
+            memory (all if None).
+
+    Return
+        (index, stores, store_idx, rows): the transition index, the
+        LazyStores of the dataset, and the position in stores and the row of
+        each transition of the index
+    """
+    if not path.endswith('/'):
+        path += '/'
+    index = get_index(path)
+    shards = get_manifest(path)['shards']
+    stores = LazyStores([shard_path(path, shard) for shard in shards],
+                        max_decoded=max_decoded)
+    blocks = np.array([block_number(shard['name']) for shard in shards])
+    order = np.argsort(blocks)
+    store_idx = order[np.searchsorted(blocks[order], index['block'])]
+    return index, stores, store_idx, np.asarray(index['row'])
+
+
+def group_epoch(epoch, store_idx, nb_stores, group_size, shuffle=False):
+    """
+    Reorders the transitions of an epoch so that their stores are visited in
+    groups of group_size stores (in random order if shuffle is True), keeping
+    the order of the transitions within each group, so that only the stores
+    of one group need to be loaded at a time (see batch_segments).
+
+    Args
+        epoch (np.array): positions in the transition index of the transitions
+            of the epoch.
+        store_idx (np.array): store of each transition of the index (see
+            index_stores).
+        nb_stores (int): number of stores.
+        group_size (int): number of stores in a group.
+        shuffle (bool, False): visit the groups in random order.
+
+    Return
+        The reordered epoch
+    """
+    if group_size >= nb_stores:
+        return epoch
+    order = np.random.permutation(nb_stores) if shuffle else np.arange(nb_stores)
+    groups = np.empty(nb_stores, dtype=np.int64)
+    groups[order] = np.arange(nb_stores) // group_size
+    return epoch[np.argsort(groups[store_idx[epoch]], kind='mergesort')]
+
 
-    return samples_in_dataset
+def split_episodes(path, valid_fraction=0.1, random_state=None):
+    """
+    Splits the transitions of the dataset in path in a training and a
+    validation set, by episode (so that no episode has transitions in both
+    sets). Episode ids are the ones of the transition index, so episodes of
+    different collections of an aggregated dataset may be grouped together.
 
+    Args
+        path (str): path to folder containing 'sars_*' frame stores (as collected
+            with collect_sars_to_disk)
+        valid_fraction (float, 0.1): fraction of episodes in the validation set.
+        random_state (int, None): seed of the split.
 
-def sar_generator_from_disk(path, model, batch_size=32, binarize=False, shuffle=False, weights=None):
+    Return
+        (train, valid): the positions in the transition index of the training
+        and validation transitions (valid is empty if the dataset has a single
+        episode)
+    """
+    ids, episodes = np.unique(np.asarray(get_index(path)['episode']),
+                              return_inverse=True)
+    rng = np.random.RandomState(random_state)
+    nb_valid = max(1, int(round(len(ids) * valid_fraction)))
+    valid_ids = np.zeros(len(ids), dtype=bool)
+    valid_ids[rng.choice(len(ids), size=min(nb_valid, len(ids) - 1), replace=False)] = True
+    is_valid = valid_ids[episodes]
+    return np.flatnonzero(~is_valid), np.flatnonzero(is_valid)
+
+
+def subset_segments(path, subset, batch_size=32, shuffle=False):
+    """
+    Generator of batches of the given transitions of the dataset in path
+    (e.g. the training or validation transitions of split_episodes). The
+    transitions are visited once per epoch, in random order if shuffle is
+    True, and batches can span two epochs. As in batch_segments, the stores
+    are visited in groups (of two stores if they are compressed), so that
+    only the stores of a group are decoded in memory at a time.
+
+    Args
+        path (str): path to folder containing 'sars_*' frame stores (as collected
+            with collect_sars_to_disk)
+        subset (np.array): positions of the transitions in the transition index
+            (ValueError if empty).
+        batch_size (int, 32): number of transitions in a batch.
+        shuffle (bool, False): shuffle the transitions at each epoch.
+
+    Yield
+        segments (list): list of (FrameStore, np.array) tuples with the rows of
+            each store that belong to the batch (see batch_segments).
+    """
+    subset = np.asarray(subset)
+    if len(subset) == 0:
+        raise ValueError('Empty subset of transitions (e.g. a validation set '
+                         'of a dataset with a single episode)')
+    files = get_sars_files(path)
+    group_size = shard_group_size(files, shuffle=shuffle)
+    # The batches at the end of a group also take from the next one
+    _, stores, store_idx, rows = index_stores(path, max_decoded=2 * group_size)
+    pending = subset[:0]
+    while True:
+        while len(pending) < batch_size:
+            epoch = np.random.permutation(subset) if shuffle else subset
+            epoch = group_epoch(epoch, store_idx, len(stores), group_size,
+                                shuffle=shuffle)
+            pending = np.concatenate((pending, epoch))
+        batch = pending[:batch_size]
+        pending = pending[batch_size:]
+        yield split_batch(stores, store_idx[batch], rows[batch])
+
+
+def stratified_segments(path, batch_size=32, epoch_size=None, clip=False,
+                        subset=None):
+    """
+    Generator of batches of transitions from the frame stores in path, drawn
+    in reward-balanced epochs: each epoch draws the same number of
+    transitions from each reward class of the transition index of the
+    dataset (with replacement for classes with fewer transitions), so that
+    rare rewards are seen at every epoch without visiting all the
+    zero-reward transitions. Transitions should be weighted with the
+    importance weights of stratified_allocation.
+    The transitions of an epoch are visited by groups of stores as in
+    subset_segments.
+
+    Args
+        path (str): path to folder containing 'sars_*' frame stores (as collected
+            with collect_sars_to_disk)
+        batch_size (int, 32): number of transitions in a batch.
+        epoch_size (int, None): number of transitions in an epoch, rounded up
+            to a multiple of batch_size (the number of transitions in the
+            dataset if None).
+        clip (bool, False): clip the rewards to [-1, 1] before stratifying.
+        subset (np.array, None): positions in the transition index of the
+            transitions to draw from (all if None).
+
+    Yield
+        segments (list): list of (FrameStore, np.array) tuples with the rows of
+            each store that belong to the batch (see batch_segments).
+    """
+    group_size = shard_group_size(get_sars_files(path), shuffle=True)
+    index, stores, store_idx, rows = index_stores(path, max_decoded=2 * group_size)
+    if subset is None:
+        subset = np.arange(len(index))
+    if len(subset) == 0:
+        raise ValueError('Empty subset of transitions')
+    index = index[subset]
+    if epoch_size is None:
+        epoch_size = len(index)
+    epoch_size = int(np.ceil(epoch_size / float(batch_size))) * batch_size
+
+    classes, allocation, _ = stratified_allocation(index, epoch_size, clip=clip)
+    members = np.searchsorted(classes, reward_classes(index, clip=clip))
+    members = [subset[members == c] for c in range(len(classes))]
+
+    while True:
+        epoch = np.concatenate([np.random.choice(m, size=n, replace=n > len(m))
+                                for m, n in zip(members, allocation)])
+        np.random.shuffle(epoch)
+        epoch = group_epoch(epoch, store_idx, len(stores), group_size,
+                            shuffle=True)
+        for start in xrange(0, epoch_size, batch_size):
+            batch = epoch[start:start + batch_size]
+            yield split_batch(stores, store_idx[batch], rows[batch])
+
+
+def buffer(buffers, key, shape, dtype):
+    """
+    Returns the array stored in buffers under key, allocating it on first use.
+    """
+    if key not in buffers:
+        buffers[key] = np.empty(shape, dtype=dtype)
+    return buffers[key]
+
+
+def batch_generator_from_disk(path, columns, transform, batch_size=32,
+                              shuffle=False, shuffle_buffer=None, n_workers=0,
+                              queue_size=8, hold=1, segments=None):
+    """
+    Generic generator of batches from SARS datasets saved in path.
+    The columns of each batch are gathered from the stores (across store
+    boundaries) directly into preallocated arrays, and then passed to a
+    transform that builds the output of the generator.
+
+    Args
+        path (str): path to folder containing 'sars_*' frame stores (as collected
+            with collect_sars_to_disk)
+        columns (list): list of (name, source) tuples with the columns of a
+            batch. A source is either 'S' or 'SS' (stacked states), the name of
+            a FrameStore column (e.g. 'a', 'r'), or a function
+            (store, derived) -> np.array with a row for each transition of the
+            store, which is called once per loaded store (derived is the dict
+            of the columns already derived for the store, e.g. to compute
+            sample weights from residuals).
+        transform (function): (batch, buffers) -> output of the generator,
+            where batch is the dict of gathered columns and buffers is a dict
+            in which the transform can allocate its own arrays with buffer().
+        batch_size (int, 32): number of transitions in a batch.
+        shuffle (bool, False), shuffle_buffer (int, None): see batch_segments.
+        n_workers (int, 0): number of threads that prefetch and preprocess
+            batches (0 to load batches serially, when they are requested).
+        queue_size (int, 8): number of prefetched batches.
+        hold (int, 1): number of yielded batches that may still be in use by
+            the consumer (e.g. max_q_size + 2 for Keras's fit_generator);
+            the arrays of older batches are reused.
+        segments (generator, None): generator of batches as lists of
+            (store, rows) segments (e.g. stratified_segments), instead of
+            batch_segments.
+
+    Yield
+        The outputs of transform
+    """
+
+    # Derived columns are computed once for each loaded store, and dropped
+    # with it
+    derived_columns = weakref.WeakKeyDictionary()
+    derived_lock = threading.Lock()
+
+    def derive(store):
+        with derived_lock:
+            if store not in derived_columns:
+                derived = dict()
+                for name, source in columns:
+                    if callable(source):
+                        derived[name] = source(store, derived)
+                derived_columns[store] = derived
+            return derived_columns[store]
+
+    def load(segments, buffers):
+        derived = [derive(store) for store, _ in segments]
+        first = segments[0][0]
+        batch = dict()
+        for name, source in columns:
+            if source in ('S', 'SS'):
+                shape = (first.history,) + first.frame_shape
+                dtype = np.uint8
+            elif callable(source):
+                shape = derived[0][name].shape[1:]
+                dtype = derived[0][name].dtype
+            else:
+                shape = getattr(first, source).shape[1:]
+                dtype = getattr(first, source).dtype
+            out = buffer(buffers, name, (batch_size,) + shape, dtype)
+
+            start = 0
+            for (store, rows), store_derived in zip(segments, derived):
+                stop = start + len(rows)
+                if source in ('S', 'SS'):
+                    getattr(store, source)(rows, out=out[start:stop])
+                else:
+                    column = store_derived[name] if callable(source) else getattr(store, source)
+                    np.take(column, rows, axis=0, out=out[start:stop])
+                start = stop
+            batch[name] = out
+        return transform(batch, buffers)
+
+    if segments is None:
+        jobs = batch_segments(get_sars_files(path), batch_size=batch_size,
+                              shuffle=shuffle, shuffle_buffer=shuffle_buffer)
+    else:
+        jobs = segments
+    if n_workers > 0:
+        return prefetch(jobs, load, n_workers=n_workers,
+                        queue_size=queue_size, hold=hold)
+    # The arrays of a batch are reused hold batches later
+    buffers = [dict() for _ in range(hold + 1)]
+    return (load(job, buffers[i % len(buffers)]) for i, job in enumerate(jobs))
+
+
+def sar_generator_from_disk(path, model, batch_size=32, binarize=False, shuffle=False, weights=None,
+                            shuffle_buffer=None, n_workers=0, queue_size=8, hold=1):
     """
     Generator of S, A, R arrays from SARS datasets saved in path.
     
     Args
-        path (str): path to folder containing 'sars_*.pkl' files (as collected
+        path (str): path to folder containing 'sars_*' frame stores (as collected
             with collect_sars_to_disk)
+        shuffle_buffer, n_workers, queue_size, hold: see
+            batch_generator_from_disk.
     
     Yield
         (S, A, R) (np.array, np.array, np.array): np.arrays with states, 
             actions and rewards from each SARS dataset in path.
      
     """
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
+    columns = [('S', 'SS'), ('A', 'a'), ('R', 'r')]  # S'
+    if weights is not None:
+        columns.append(('W', lambda store, derived: get_sample_weight(store.r, weights)))
 
-    while True:
-        for idx, f in enumerate(files):
-            sars = np.load(f)
-            if idx > 0:
-                sars = np.append(excess_sars, sars, axis=0)
+    def transform(batch, buffers):
+        # Preprocess data
+        S = model.preprocess_state(batch['S'], binarize=binarize,
+                                   out=buffer(buffers, 'S_in', (batch_size,) + tuple(model.input_shape), np.float32))
 
-            if shuffle:
-                np.random.shuffle(sars)
-
-            excess = len(sars) % batch_size
-            if excess > 0:
-                excess_sars = sars[-excess:]
-                sars = sars[:-excess]
-            else:
-                excess_sars = sars[0:0]  # just to preserve shapes
+        if weights is not None:
+            return ([S, batch['A']], batch['R'], batch['W'])
+        else:
+            return ([S, batch['A']], batch['R'])
 
-            nb_batches = len(sars) / batch_size
+    return batch_generator_from_disk(path, columns, transform,
+                                     batch_size=batch_size, shuffle=shuffle,
+                                     shuffle_buffer=shuffle_buffer,
+                                     n_workers=n_workers,
+                                     queue_size=queue_size, hold=hold)
 
-            if weights is not None:
-                sample_weight = get_sample_weight(pds_to_npa(sars[:, 2]),
-                                                  class_weight=weights)
 
-            for i in range(nb_batches):
-                start = i * batch_size
-                stop = (i + 1) * batch_size
-                S = pds_to_npa(sars[start:stop, 3])  # S'
-                A = pds_to_npa(sars[start:stop, 1])
-                R = pds_to_npa(sars[start:stop, 2])
+def build_from_disk(path, outputs, shuffle=False, chunk_size=2048,
+                    out_path=None):
+    """
+    Generic builder of dataset matrices from SARS datasets saved in path.
+    The number of rows is read from the manifest, so each output is allocated
+    once (in memory, or as a .npy memory map in out_path) and filled one chunk
+    of transitions at a time: the working set is bounded by chunk_size,
+    whatever the size of the dataset.
 
-                # Preprocess data
-                S = model.preprocess_state(S, binarize=binarize)
+    Args
+        path (str): path to folder containing 'sars_*' frame stores (as collected
+            with collect_sars_to_disk)
+        outputs (list): list of (name, blocks) tuples. blocks is a list of
+            functions (store, rows, chunk) -> np.array with a row for each of
+            the given transitions of the store; the output is the column-wise
+            stack of its blocks (an output with a single 1D block stays 1D).
+            chunk is a dict shared by all blocks of the current chunk, in
+            which they can keep intermediate results (see state_features).
+        shuffle (bool, False): whether to shuffle the transitions of each
+            store. Chunks are still read in storage order (so that consecutive
+            transitions share their states) and written to shuffled rows.
+        chunk_size (int, 2048): number of transitions processed at once.
+        out_path (str, None): folder in which to save the outputs as
+            '<name>.npy' memory maps (in memory if None).
 
-                if weights is not None:
-                    yield ([S, A], R, sample_weight[start:stop])
+    Return
+        A dict with the outputs
+    """
+    files = get_sars_files(path)
+    nb_samples = get_nb_samples_from_disk(path)
+    if out_path is not None and not out_path.endswith('/'):
+        out_path += '/'
+    if out_path is not None and not os.path.exists(out_path):
+        os.makedirs(out_path)
+
+    result = dict()
+    start = 0  # First row of the current store in the outputs
+    for f in files:
+        sars = FrameStore.load(f)
+        if shuffle:
+            destination = start + np.random.permutation(len(sars))
+        for i in xrange(0, len(sars), chunk_size):
+            rows = np.arange(i, min(i + chunk_size, len(sars)))
+            if shuffle:
+                dest = destination[rows]
+            else:
+                dest = slice(start + i, start + i + len(rows))
+            chunk = dict()
+            for name, blocks in outputs:
+                values = [np.asarray(b(sars, rows, chunk)) for b in blocks]
+                if len(values) == 1 and values[0].ndim == 1:
+                    shape = (nb_samples,)
                 else:
-                    yield ([S, A], R)
+                    values = [v.reshape(len(rows), -1) for v in values]
+                    shape = (nb_samples, sum(v.shape[1] for v in values))
+                if name not in result:
+                    dtype = np.result_type(*values)
+                    if out_path is None:
+                        result[name] = np.empty(shape, dtype=dtype)
+                    else:
+                        result[name] = np.lib.format.open_memmap(
+                            out_path + name + '.npy', mode='w+', dtype=dtype,
+                            shape=shape)
+                column = 0
+                for v in values:
+                    width = 1 if v.ndim == 1 else v.shape[1]
+                    if len(shape) == 1:
+                        result[name][dest] = v
+                    else:
+                        result[name][dest, column:column + width] = v
+                    column += width
+        start += len(sars)
 
+    return result
 
-def build_far_from_disk(nn, path, use_ss=False, shuffle=False):
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
 
-    state_idx = 3 if use_ss else 0
+def state_features(encode, store, rows, chunk=None, key='features'):
+    """
+    Returns the features of the states S and S' of the given transitions,
+    encoding each distinct state only once: S' of a transition is S of the
+    next transition of the episode (the same frame stack), so only the S' of
+    the last transition of an episode (or of a chunk) requires an additional
+    encoding.
 
-    for idx, f in enumerate(files):
-        sars = np.load(f)
-        if shuffle:
-            np.random.shuffle(sars)
-        if idx == 0:
-            F = nn.all_features(pds_to_npa(sars[:, state_idx]))
-            A = pds_to_npa(sars[:, 1])
-            R = pds_to_npa(sars[:, 2])
-        else:
-            new_F = nn.all_features(pds_to_npa(sars[:, state_idx]))
-            new_A = pds_to_npa(sars[:, 1])
-            new_R = pds_to_npa(sars[:, 2])
-            F = np.append(F, new_F, axis=0)
-            A = np.append(A, new_A, axis=0)
-            R = np.append(R, new_R, axis=0)
+    Args
+        encode (function): np.array of stacked states -> np.array of features
+        store (FrameStore): the store of the transitions
+        rows (np.array): indices of the transitions in the store
+        chunk (dict, None): if given, the features are cached in chunk[key],
+            so that several blocks of build_from_disk share them.
+        key (str, 'features'): key of the features in chunk (one for each
+            encoder).
 
-    A = A.reshape(-1, 1)
-    FA = np.concatenate((F, A), axis=1)
+    Return
+        (F, FF), the features of S and S'
+    """
+    if chunk is not None and key in chunk:
+        return chunk[key]
+    last = np.concatenate((np.asarray(store.s[rows]), np.asarray(store.ss[rows])))
+    states, inverse = np.unique(last, return_inverse=True)
+    features = np.asarray(encode(store.stack(states))).reshape(len(states), -1)
+    result = (features[inverse[:len(rows)]], features[inverse[len(rows):]])
+    if chunk is not None:
+        chunk[key] = result
+    return result
+
+
+def build_far_from_disk(nn, path, use_ss=False, shuffle=False, chunk_size=2048,
+                        out_path=None):
+    """
+    Builds the FA, R dataset using all SARS' datasets saved in path (see
+    build_from_disk for chunk_size and out_path).
+    """
+    def features(sars, rows, chunk):
+        return nn.all_features(sars.SS(rows) if use_ss else sars.S(rows))
+
+    out = build_from_disk(path,
+                          [('FA', [features, lambda sars, rows, chunk: sars.a[rows]]),
+                           ('R', [lambda sars, rows, chunk: sars.r[rows]])],
+                          shuffle=shuffle, chunk_size=chunk_size,
+                          out_path=out_path)
 
     # Post processing
-    R = R.reshape(-1, 1)  # Sklearn version < 0.19 will throw a warning
-    return FA, R
+    R = out['R'].reshape(-1, 1)  # Sklearn version < 0.19 will throw a warning
+    return out['FA'], R
 
 
 def build_fd(nn_stack, nn, support, sars, shuffle=False):
+    rows = np.arange(len(sars))
     if shuffle:
-        np.random.shuffle(sars)
-    S = pds_to_npa(sars[:, 0])
-    SS = pds_to_npa(sars[:, 3])
-    F = nn_stack.s_features(S, SS)
-    D = nn.s_features(S, support) - nn.s_features(SS, support)
+        np.random.shuffle(rows)
+    F = nn_stack.s_features(sars.S(rows), sars.SS(rows))
+    F_nn, FF_nn = state_features(lambda x: nn.s_features(x, support), sars, rows)
+    D = F_nn - FF_nn
     return F, D
 
 
-def build_fd_from_disk(nn_stack, nn, support, path, shuffle=False):
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
-
-    for idx, f in enumerate(files):
-        sars = np.load(f)
-        if shuffle:
-            np.random.shuffle(sars)
-        S = pds_to_npa(sars[:, 0])
-        SS = pds_to_npa(sars[:, 3])
-        if idx == 0:
-            F = nn_stack.s_features(S, SS)
-            D = nn.s_features(S, support) - nn.s_features(SS, support)
-        else:
-            new_F = nn_stack.s_features(S, SS)
-            new_D = nn.s_features(S, support) - nn.s_features(SS, support)
-            F = np.append(F, new_F, axis=0)
-            D = np.append(D, new_D, axis=0)
-
-    return F, D
-
+def build_fd_from_disk(nn_stack, nn, support, path, shuffle=False,
+                       chunk_size=2048, out_path=None):
+    """
+    Builds the F, D dataset using all SARS' datasets saved in path (see
+    build_from_disk for chunk_size and out_path).
+    """
+    def features(sars, rows, chunk):
+        return nn_stack.s_features(sars.S(rows), sars.SS(rows))
 
-def build_fa_from_disk(nn_stack, nn, path, shuffle=False):
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
+    def dynamics(sars, rows, chunk):
+        F, FF = state_features(lambda x: nn.s_features(x, support), sars, rows)
+        return F - FF
 
-    for idx, f in enumerate(files):
-        sars = np.load(f)
-        if shuffle:
-            np.random.shuffle(sars)
-        S = pds_to_npa(sars[:, 0])
-        SS = pds_to_npa(sars[:, 3])
-        if idx == 0:
-            F = np.column_stack((nn_stack.s_features(S, SS), nn.all_features(S)))
-            A = pds_to_npa(sars[:, 1])
-        else:
-            new_F = np.column_stack((nn_stack.s_features(S, SS), nn.all_features(S)))
-            new_A = pds_to_npa(sars[:, 1])
-            F = np.append(F, new_F, axis=0)
-            A = np.append(A, new_A, axis=0)
+    out = build_from_disk(path, [('F', [features]), ('D', [dynamics])],
+                          shuffle=shuffle, chunk_size=chunk_size,
+                          out_path=out_path)
+    return out['F'], out['D']
 
-    A = A.reshape(-1, 1)
-    FA = np.concatenate((F, A), axis=1)
-    return FA
 
+def build_fa_from_disk(nn_stack, nn, path, shuffle=False, chunk_size=2048,
+                       out_path=None):
+    """
+    Builds the FA dataset using all SARS' datasets saved in path (see
+    build_from_disk for chunk_size and out_path).
+    """
+    out = build_from_disk(path,
+                          [('FA', [lambda sars, rows, chunk: nn_stack.s_features(sars.S(rows), sars.SS(rows)),
+                                   lambda sars, rows, chunk: nn.all_features(sars.S(rows)),
+                                   lambda sars, rows, chunk: sars.a[rows]])],
+                          shuffle=shuffle, chunk_size=chunk_size,
+                          out_path=out_path)
+    return out['FA']
 
-def build_r_from_disk(path, shuffle=False):
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
-    for idx, f in enumerate(files):
-        sars = np.load(f)
-        if shuffle:
-            np.random.shuffle(sars)
-        if idx == 0:
-            R = pds_to_npa(sars[:, 2])
-        else:
-            R = np.append(R, pds_to_npa(sars[:, 2]))
 
-    return R
+def build_r_from_disk(path, shuffle=False, out_path=None):
+    """
+    Builds the R dataset using all SARS' datasets saved in path (see
+    build_from_disk for out_path).
+    """
+    out = build_from_disk(path, [('R', [lambda sars, rows, chunk: sars.r[rows]])],
+                          shuffle=shuffle, out_path=out_path)
+    return out['R']
 
 
 def build_res(model, F, D, no_residuals=False):
@@ -358,7 +1151,9 @@ def build_res(model, F, D, no_residuals=False):
 
 def sares_generator_from_disk(model, nn_stack, nn, support, path, batch_size=32,
                               binarize=False, no_residuals=False, weights=None,
-                              scale_coeff=1, round_decimal=1, shuffle=False):
+                              scale_coeff=1, round_decimal=1, shuffle=False,
+                              shuffle_buffer=None, n_workers=0, queue_size=8,
+                              hold=1):
     """
     Generator of S, A, RES arrays from SARS datasets saved in path.
 
@@ -367,63 +1162,50 @@ def sares_generator_from_disk(model, nn_stack, nn, support, path, batch_size=32,
         nn_stack (NNStack)
         nn (ConvNet or GenericEncoder)
         support (np.array): support mask for nn
-        path (str): path to folder containing 'sars_*.pkl' files (as collected
+        path (str): path to folder containing 'sars_*' frame stores (as collected
             with collect_sars_to_disk)
         no_residuals (bool, False): whether to return residuals or dynamics in 
             the RES column of the sares dataset.
         class_weigth (dict, None): passed to the get_sample_weight method 
         test_sfadf (pd.DataFrame, None): compute the test SARES dataset from 
             this dataset.
+        shuffle_buffer, n_workers, queue_size, hold: see
+            batch_generator_from_disk.
     """
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
-
-    while True:
-        for idx, f in enumerate(files):
-            sars = np.load(f)
-            if shuffle:
-                np.random.shuffle(sars)
-            if idx > 0:
-                sars = np.append(excess_sars, sars, axis=0)
-
-            excess = len(sars) % batch_size
-            if excess > 0:
-                excess_sars = sars[-excess:]
-                sars = sars[:-excess]
-            else:
-                excess_sars = sars[0:0]  # just to preserve shapes
-
-            nb_batches = len(sars) / batch_size
-
-            # Compute residuals
-            F, D = build_fd(nn_stack, nn, support, sars)
-            RES = build_res(model, F, D, no_residuals=no_residuals)
-
-            for i in range(nb_batches):
-                start = i * batch_size
-                stop = (i + 1) * batch_size
-                S = pds_to_npa(sars[start:stop, 0])
-                A = pds_to_npa(sars[start:stop, 1])
-
-                if weights is not None:
-                    if callable(weights):  # it's a PDF function
-                        sample_weight = 1. / weights(np.round(RES[start:stop], round_decimal).T)
-                        sample_weight /= scale_coeff
-                    else:  # it's a class weight dict
-                        sample_weight = get_sample_weight(np.round(RES[start:stop], round_decimal), weights)
-
-                # Preprocess data
-                S = model.preprocess_state(S, binarize=binarize)
+    def residuals(store, derived):
+        F, D = build_fd(nn_stack, nn, support, store)
+        return build_res(model, F, D, no_residuals=no_residuals)
+
+    def sample_weight(store, derived):
+        RES = np.round(derived['RES'], round_decimal)
+        if callable(weights):  # it's a PDF function
+            return 1. / weights(RES.T) / scale_coeff
+        else:  # it's a class weight dict
+            return get_sample_weight(RES, weights)
+
+    columns = [('S', 'S'), ('A', 'a'), ('RES', residuals)]
+    if weights is not None:
+        columns.append(('W', sample_weight))
+
+    def transform(batch, buffers):
+        # Preprocess data
+        S = model.preprocess_state(batch['S'], binarize=binarize,
+                                   out=buffer(buffers, 'S_in', (batch_size,) + tuple(model.input_shape), np.float32))
+
+        if weights is not None:
+            return ([S, batch['A']], batch['RES'], batch['W'])
+        else:
+            return ([S, batch['A']], batch['RES'])
 
-                if weights is not None:
-                    yield ([S, A], RES[start:stop], sample_weight)
-                else:
-                    yield ([S, A], RES[start:stop])
+    return batch_generator_from_disk(path, columns, transform,
+                                     batch_size=batch_size, shuffle=shuffle,
+                                     shuffle_buffer=shuffle_buffer,
+                                     n_workers=n_workers,
+                                     queue_size=queue_size, hold=hold)
 
 
-def build_faft_r_from_disk(nn_stack, path, shuffle=False):
+def build_faft_r_from_disk(nn_stack, path, shuffle=False, chunk_size=2048,
+                           out_path=None, cache=None):
     """
     Builds FARF' dataset using all SARS' datasets saved in path:
         F = NN_stack.s_features(S)
@@ -431,39 +1213,33 @@ def build_faft_r_from_disk(nn_stack, path, shuffle=False):
         R = R
         F' = NN_stack.s_features(S')
         DONE = DONE
+    The FAF'DONE matrix is preallocated and filled one chunk of transitions
+    at a time (see build_from_disk for chunk_size and out_path), and each
+    distinct state is encoded once (see state_features).
+    If a FeatureCache is given, the features are read from the cache (and
+    filtered by the support of nn_stack, which must be a single encoder).
     """
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
+    # The weights of the encoder are hashed once for the whole build
+    encoder = encoder_key(nn_stack) if cache is not None else None
 
-    for idx, f in enumerate(files):
-        sars = np.load(f)
-        if shuffle:
-            np.random.shuffle(sars)
-        S = pds_to_npa(sars[:, 0])
-        SS = pds_to_npa(sars[:, 3])
-        if idx == 0:
-            F = nn_stack.s_features(S)
-            A = pds_to_npa(sars[:, 1])
-            R = pds_to_npa(sars[:, 2])
-            FF = nn_stack.s_features(SS)
-            DONE = pds_to_npa(sars[:, 4])
-        else:
-            new_F = nn_stack.s_features(S)
-            new_A = pds_to_npa(sars[:, 1])
-            new_R = pds_to_npa(sars[:, 2])
-            new_FF = nn_stack.s_features(SS)
-            new_DONE = pds_to_npa(sars[:, 4])
-            F = np.append(F, new_F, axis=0)
-            A = np.append(A, new_A, axis=0)
-            R = np.append(R, new_R, axis=0)
-            FF = np.append(FF, new_FF, axis=0)
-            DONE = np.append(DONE, new_DONE, axis=0)
-
-    faft = np.column_stack((F, A, FF, DONE))
-    action_values = np.unique(A)
-    return faft, R, action_values
+    def features(sars, rows, chunk):
+        if cache is not None:
+            return cache.state_features(nn_stack, sars, rows,
+                                        support=nn_stack.support,
+                                        encoder=encoder)
+        return state_features(nn_stack.s_features, sars, rows, chunk)
+
+    out = build_from_disk(path,
+                          [('FAFT', [lambda sars, rows, chunk: features(sars, rows, chunk)[0],
+                                     lambda sars, rows, chunk: sars.a[rows],
+                                     lambda sars, rows, chunk: features(sars, rows, chunk)[1],
+                                     lambda sars, rows, chunk: sars.done[rows]]),
+                           ('R', [lambda sars, rows, chunk: sars.r[rows]])],
+                          shuffle=shuffle, chunk_size=chunk_size,
+                          out_path=out_path)
+
+    action_values = np.array(sorted(total_counts(get_manifest(path), 'actions')))
+    return out['FAFT'], out['R'], action_values
 
 
 def get_sample_weight(target, class_weight):
@@ -482,127 +1258,143 @@ def get_sample_weight(target, class_weight):
             applying the class weights.
     """
     if isinstance(target, pd.DataFrame):
-        target = pds_to_npa(target.R)
+        target = np.asarray(target.R)
     else:
-        target = pds_to_npa(target)
+        target = np.asarray(target)
 
     if target.ndim == 2 and target.shape[1] == 1:
         target = target.ravel()
 
-    sample_weight = [class_weight[r] for r in target]
-    return np.array(sample_weight)
+    # Look up each class once, then broadcast the weights to the samples
+    classes, inverse = np.unique(target, return_inverse=True)
+    class_weights = np.array([class_weight[c] for c in classes])
+    return class_weights[inverse.reshape(target.shape)]
 
 
 def get_nb_samples_from_disk(path):
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
-
-    result = 0
-    for f in files:
-        sars = np.load(f)
-        result += len(sars)
-
-    return result
+    return sum(shard['rows'] for shard in get_manifest(path)['shards'])
 
 
 def get_class_weight_from_disk(path, clip=False):
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
-    for idx, f in enumerate(files):
-        sars = np.load(f)
-        if idx == 0:
-            target = pds_to_npa(sars[:, 2])
-        else:
-            target = np.append(target, pds_to_npa(sars[:, 2]))
+    counts = total_counts(get_manifest(path), 'rewards')
 
     if clip:
-        target = np.clip(target, -1, 1)
+        clipped_counts = dict()
+        for r, c in counts.items():
+            r = float(np.clip(r, -1, 1))
+            clipped_counts[r] = clipped_counts.get(r, 0) + c
+        counts = clipped_counts
 
     class_weight = dict()
-    reward_classes = np.unique(target)
-    for r in reward_classes:
-        class_weight[r] = target.size / float(np.argwhere(target == r).size)
+    total = sum(counts.values())
+    for r in sorted(counts):
+        class_weight[r] = total / float(counts[r])
 
     return class_weight
 
 
 def ss_generator_from_disk(path, model, batch_size=32, binarize=False,
                            binarization_threshold=0.1,
-                           weights=None, shuffle=False, clip=False):
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
+                           weights=None, shuffle=False, clip=False,
+                           shuffle_buffer=None, n_workers=0, queue_size=8,
+                           hold=1, stratify=False, epoch_size=None,
+                           subset=None):
+    """
+    Generator of (S, S) batches from SARS datasets saved in path, to train
+    autoencoders.
 
-    while True:
-        for idx, f in enumerate(files):
-            sars = np.load(f)
-            if shuffle:
-                np.random.shuffle(sars)
-            if idx > 0:
-                sars = np.append(excess_sars, sars, axis=0)
-
-            excess = len(sars) % batch_size
-            if excess > 0:
-                excess_sars = sars[-excess:]
-                sars = sars[:-excess]
-            else:
-                excess_sars = sars[0:0]  # just to preserve shapes
+    Args
+        path (str): path to folder containing 'sars_*' frame stores (as collected
+            with collect_sars_to_disk)
+        shuffle_buffer, n_workers, queue_size, hold: see
+            batch_generator_from_disk.
+        stratify (bool, False): draw reward-balanced epochs of epoch_size
+            transitions (see stratified_segments) and weight the samples with
+            their importance weights (multiplied by the class weights, if
+            given).
+        epoch_size (int, None): see stratified_segments.
+        subset (np.array, None): positions in the transition index of the
+            transitions to use (e.g. the training or validation set of
+            split_episodes), instead of the whole dataset.
+    """
+    columns = [('S', 'S')]
+    segments = None
+    if stratify:
+        index = get_index(path)
+        # Weights are derived for all the rows of the loaded stores, so the
+        # classes that only appear outside of the subset (never drawn) get a
+        # weight of 1
+        importance = dict((c, 1.) for c in np.unique(reward_classes(index, clip=clip)))
+        if subset is not None:
+            index = index[subset]
+        if epoch_size is None:
+            epoch_size = len(index)
+        # The weights must match the epochs drawn by stratified_segments
+        epoch_size = int(np.ceil(epoch_size / float(batch_size))) * batch_size
+        classes, _, subset_importance = stratified_allocation(index, epoch_size, clip=clip)
+        importance.update(zip(classes, subset_importance))
+        segments = stratified_segments(path, batch_size=batch_size,
+                                       epoch_size=epoch_size, clip=clip,
+                                       subset=subset)
+    elif subset is not None:
+        segments = subset_segments(path, subset, batch_size=batch_size,
+                                   shuffle=shuffle)
+
+    if weights is not None or stratify:
+        def sample_weight(store, derived):
+            R = np.clip(store.r, -1, 1) if clip else store.r
+            W = np.ones(len(R))
+            if weights is not None:
+                W *= get_sample_weight(R, class_weight=weights)
+            if stratify:
+                W *= get_sample_weight(R, class_weight=importance)
+            return W
+        columns.append(('W', sample_weight))
+
+    def transform(batch, buffers):
+        # Preprocess data
+        S = model.preprocess_state(batch['S'], binarize=binarize, binarization_threshold=binarization_threshold,
+                                   out=buffer(buffers, 'S_in', (batch_size,) + tuple(model.input_shape), np.float32))
+
+        if weights is not None or stratify:
+            return (S, S, batch['W'])
+        else:
+            return (S, S)
 
-            nb_batches = len(sars) / batch_size
+    return batch_generator_from_disk(path, columns, transform,
+                                     batch_size=batch_size, shuffle=shuffle,
+                                     shuffle_buffer=shuffle_buffer,
+                                     n_workers=n_workers,
+                                     queue_size=queue_size, hold=hold,
+                                     segments=segments)
 
-            if weights is not None:
-                R = pds_to_npa(sars[:, 2])
-                if clip:
-                    R = np.clip(R, -1, 1)
-                sample_weight = get_sample_weight(R,
-                                                  class_weight=weights)
-
-            for i in range(nb_batches):
-                start = i * batch_size
-                stop = (i + 1) * batch_size
-                S = pds_to_npa(sars[start:stop, 0])
-
-                # Preprocess data
-                S = model.preprocess_state(S, binarize=binarize, binarization_threshold=binarization_threshold)
-
-                if weights is not None:
-                    yield (S, S, sample_weight[start:stop])
-                else:
-                    yield (S, S)
 
+def build_farf_from_disk(model, path, shuffle=False, chunk_size=2048,
+                         out_path=None, cache=None):
+    """
+    Builds the F, A, R, F' dataset using all SARS' datasets saved in path (see
+    build_from_disk for chunk_size and out_path), encoding each distinct state
+    once (see state_features). If a FeatureCache is given, the features are
+    read from the cache.
+    """
+    # The weights of the encoder are hashed once for the whole build
+    encoder = encoder_key(model) if cache is not None else None
 
-def build_farf_from_disk(model, path, shuffle=False):
-    if not path.endswith('/'):
-        path += '/'
-    files = glob.glob(path + 'sars_*.npy')
-    print 'Got %s files' % len(files)
+    def features(sars, rows, chunk):
+        if cache is not None:
+            return cache.state_features(model, sars, rows, encoder=encoder)
+        return state_features(model.all_features, sars, rows, chunk)
 
-    for idx, f in enumerate(files):
-        sars = np.load(f)
-        if shuffle:
-            np.random.shuffle(sars)
-        if idx == 0:
-            F = model.all_features(pds_to_npa(sars[:, 0]))
-            A = pds_to_npa(sars[:, 1])
-            R = pds_to_npa(sars[:, 2])
-            FF = model.all_features(pds_to_npa(sars[:, 3]))
-        else:
-            new_F = model.all_features(pds_to_npa(sars[:, 0]))
-            new_A = pds_to_npa(sars[:, 1])
-            new_R = pds_to_npa(sars[:, 2])
-            new_FF = model.all_features(pds_to_npa(sars[:, 3]))
-            F = np.append(F, new_F, axis=0)
-            A = np.append(A, new_A, axis=0)
-            R = np.append(R, new_R, axis=0)
-            FF = np.append(FF, new_FF, axis=0)
+    out = build_from_disk(path,
+                          [('F', [lambda sars, rows, chunk: features(sars, rows, chunk)[0]]),
+                           ('A', [lambda sars, rows, chunk: sars.a[rows]]),
+                           ('R', [lambda sars, rows, chunk: sars.r[rows]]),
+                           ('FF', [lambda sars, rows, chunk: features(sars, rows, chunk)[1]])],
+                          shuffle=shuffle, chunk_size=chunk_size,
+                          out_path=out_path)
 
-    A = A.reshape(-1, 1)
+    A = out['A'].reshape(-1, 1)
 
     # Post processing
-    R = R.reshape(-1, 1)  # Sklearn version < 0.19 will throw a warning
-    return F, A, R, FF
\ No newline at end of file
+    R = out['R'].reshape(-1, 1)  # Sklearn version < 0.19 will throw a warning
+    return out['F'], A, R, out['FF']
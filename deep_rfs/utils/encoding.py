@@ -0,0 +1,103 @@
+import time
+from operator import mul
+
+import numpy as np
+
+
+def chunk_limit(input_shape, max_bytes=2 ** 28):
+    """
+    :param input_shape: shape of a preprocessed (float32) state
+    :param max_bytes: size budget of the preprocessing buffer
+    :return: the largest number of states whose preprocessed inputs fit in
+    max_bytes
+    """
+    return max(1, max_bytes // (4 * reduce(mul, input_shape)))
+
+
+class ChunkTuner:
+    def __init__(self, chunk_size=256, max_size=4096, tolerance=0.05):
+        """
+        Tunes the number of states encoded at once by throughput: the chunk
+        size is doubled as long as the throughput (states per second) of the
+        encoded chunks improves by more than `tolerance`, and set back to the
+        best size as soon as it does not.
+        The first chunk (which includes the setup of the model) and the chunks
+        smaller than the chunk size are not measured.
+        :param chunk_size: initial number of states in a chunk
+        :param max_size: maximum number of states in a chunk (see chunk_limit)
+        :param tolerance: relative improvement of the throughput required to
+        double the chunk size
+        """
+        self.chunk_size = min(chunk_size, max_size)
+        self.max_size = max_size
+        self.tolerance = tolerance
+        self.best = None  # Throughput of the best chunk size
+        self.tuned = False
+        self.warmup = True
+
+    def update(self, n, seconds):
+        """
+        :param n: number of states of the last chunk
+        :param seconds: time taken to preprocess and encode the chunk
+        """
+        if self.tuned or n < self.chunk_size:
+            return
+        if self.warmup:
+            self.warmup = False
+            return
+        throughput = n / max(seconds, 1e-9)
+        if self.best is None or throughput > self.best * (1 + self.tolerance):
+            self.best = throughput
+            if self.chunk_size * 2 <= self.max_size:
+                self.chunk_size *= 2
+            else:
+                self.tuned = True
+        else:
+            self.chunk_size //= 2  # The previous size was better
+            self.tuned = True
+
+
+def encode_in_chunks(predict, preprocess, x, input_shape, output_shape,
+                     out=None, chunk_size=None, tuner=None, buffers=None):
+    """
+    Encodes any number of uint8 states in chunks, preprocessing each chunk
+    into a reused float32 buffer and writing its features in `out`, so that
+    memory does not scale with the number of states.
+    :param predict: function that encodes a batch of preprocessed states
+    (e.g. encoder.predict_on_batch)
+    :param preprocess: function (states, out) that preprocesses uint8 states
+    into the float32 array out
+    :param x: uint8 states (np.array, memmap or anything that can be sliced
+    into np.arrays)
+    :param input_shape: shape of a preprocessed state
+    :param output_shape: shape of the features of a state (used to allocate
+    out)
+    :param out: np.array (or memmap) in which to write the features (allocated
+    if None)
+    :param chunk_size: number of states encoded at once (tuned by `tuner` if
+    None)
+    :param tuner: ChunkTuner that sets the chunk size
+    :param buffers: dict in which the preprocessing buffer is kept across
+    calls
+    :return: out, with the features of the states
+    """
+    n = len(x)
+    if out is None:
+        out = np.empty((n,) + tuple(output_shape), dtype=np.float32)
+    if buffers is None:
+        buffers = {}
+    start = 0
+    while start < n:
+        size = chunk_size or tuner.chunk_size
+        stop = min(start + size, n)
+        if 'inputs' not in buffers or len(buffers['inputs']) < stop - start:
+            buffers['inputs'] = np.empty((stop - start,) + tuple(input_shape),
+                                         dtype=np.float32)
+
+        begin = time.time()
+        inputs = preprocess(np.asarray(x[start:stop]), buffers['inputs'][:stop - start])
+        out[start:stop] = np.asarray(predict(inputs)).reshape(out[start:stop].shape)
+        if chunk_size is None:
+            tuner.update(stop - start, time.time() - begin)
+        start = stop
+    return out
@@ -0,0 +1,159 @@
+import hashlib
+import os
+import shutil
+import time
+
+import numpy as np
+
+
+def encoder_key(model):
+    """
+    :param model: an encoder with an `encoder` Keras model (e.g. Autoencoder
+    or GenericEncoder)
+    :return: a hash of the encoder weights and of the preprocessing settings
+    of the model (reading all the weights of the encoder, so it should be
+    computed once for all the shards encoded with the same weights)
+    """
+    digest = hashlib.sha1()
+    for w in model.encoder.get_weights():
+        digest.update(str(w.shape).encode())
+        digest.update(np.ascontiguousarray(w).tobytes())
+    digest.update(repr((bool(getattr(model, 'binarize', False)),
+                        float(getattr(model, 'binarization_threshold', 0.1)))).encode())
+    return digest.hexdigest()
+
+
+def shard_key(store):
+    """
+    :param store: a FrameStore loaded from disk
+    :return: a hash of the location of the store and of the time at which it
+    was saved
+    """
+    if store.path is None:
+        raise ValueError('Only stores loaded from disk can be cached')
+    path = os.path.realpath(store.path)
+    stamp = os.path.getmtime(os.path.join(path, 'store.json'))
+    return hashlib.sha1(repr((path, stamp)).encode()).hexdigest()
+
+
+class FeatureCache:
+    def __init__(self, path, max_bytes=None, chunk_size=2048):
+        """
+        Persistent cache of the features of the states of FrameStore shards.
+        An entry holds the full (i.e. not filtered by the support) features of
+        every distinct state of a shard, and is identified by the weights and
+        preprocessing settings of the encoder and by the shard, so that it
+        remains valid across runs (e.g. with --load-sars and --load-ae) and is
+        ignored as soon as the encoder is trained again.
+        Least recently used entries are evicted when the cache grows over
+        max_bytes.
+        :param path: folder of the cache
+        :param max_bytes: size budget of the cache (unbounded if None)
+        :param chunk_size: number of states encoded at once when filling an
+        entry
+        """
+        if not path.endswith('/'):
+            path += '/'
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self.hits = 0
+        self.misses = 0
+        self._last = None  # (encoder key, shard key, entry) of the last entry used
+
+    def _entry_path(self, key):
+        return self.path + key + '/'
+
+    def _entries(self):
+        return [d for d in os.listdir(self.path)
+                if os.path.isdir(self.path + d) and not d.endswith('.tmp')]
+
+    def _entry_size(self, key):
+        entry = self._entry_path(key)
+        return sum(os.path.getsize(entry + f) for f in os.listdir(entry))
+
+    def _evict(self, keep):
+        if self.max_bytes is None:
+            return
+        entries = [(os.path.getmtime(self._entry_path(k)), k, self._entry_size(k))
+                   for k in self._entries()]
+        total = sum(e[2] for e in entries)
+        for _, k, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if k == keep:
+                continue
+            shutil.rmtree(self._entry_path(k), ignore_errors=True)
+            total -= size
+
+    def _fill(self, model, store, key):
+        # Encode the distinct states of the store in a temporary folder,
+        # which is renamed only when complete
+        tmp = self.path + key + '.%s.tmp/' % os.getpid()
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        states = np.union1d(np.asarray(store.s), np.asarray(store.ss))
+        np.save(tmp + 'states.npy', states)
+        features = np.lib.format.open_memmap(
+            tmp + 'features.npy', mode='w+', dtype=np.float32,
+            shape=(len(states), int(np.prod(model.encoder.output_shape[1:]))))
+        for start in xrange(0, len(states), self.chunk_size):
+            chunk = states[start:start + self.chunk_size]
+            # Features are written directly in the memory-mapped file
+            model.encode(store.stack(chunk), out=features[start:start + len(chunk)])
+        del features  # Flush to disk
+        try:
+            os.rename(tmp, self._entry_path(key))
+        except OSError:  # Filled concurrently by another process
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def features(self, model, store, encoder=None):
+        """
+        Returns the features of all distinct states of a store, encoding them
+        with model.encode and saving them if they are not cached.
+        :param model: the encoder
+        :param store: a FrameStore loaded from disk
+        :param encoder: encoder_key(model), computed if None
+        :return: (states, features), the sorted indices of the last frame of
+        the states and the memory-mapped np.array with their features
+        """
+        shard = shard_key(store)
+        if encoder is None:
+            encoder = encoder_key(model)
+        if self._last is not None and self._last[:2] == (encoder, shard):
+            return self._last[2]
+
+        key = encoder + '_' + shard
+        entry = self._entry_path(key)
+        if os.path.exists(entry):
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._fill(model, store, key)
+            self._evict(keep=key)
+        os.utime(entry, (time.time(), time.time()))  # Mark as recently used
+        self._last = (encoder, shard,
+                      (np.load(entry + 'states.npy'),
+                       np.load(entry + 'features.npy', mmap_mode='r')))
+        return self._last[2]
+
+    def state_features(self, model, store, rows, support=None, encoder=None):
+        """
+        :param model: the encoder
+        :param store: a FrameStore loaded from disk
+        :param rows: indices of the transitions in the store
+        :param support: boolean mask of the features to keep (all if None)
+        :param encoder: encoder_key(model), computed if None
+        :return: (F, FF), the features of the states S and S' of the given
+        transitions
+        """
+        states, features = self.features(model, store, encoder=encoder)
+        F = features[np.searchsorted(states, store.s[rows])]
+        FF = features[np.searchsorted(states, store.ss[rows])]
+        if support is not None:
+            F = F[:, support]
+            FF = FF[:, support]
+        return F, FF
@@ -0,0 +1,442 @@
+import errno
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from deep_rfs.utils.codec import decode_frames, encode_frames
+from deep_rfs.utils.manifest import add_summaries, summarize
+from deep_rfs.utils.preprocessing import binarization_level
+
+# Columns of a FrameStore and their on-disk types
+COLUMNS = ('frames', 's', 'ss', 'a', 'r', 'done', 'episode')
+DTYPES = {'frames': np.uint8,
+          's': np.int64,
+          'ss': np.int64,
+          'a': np.int32,
+          'r': np.float32,
+          'done': np.bool_,
+          'episode': np.int32}
+FRAMES_CHUNK_SIZE = 256  # Frames in a compressed chunk
+
+
+class FrameStore:
+    def __init__(self, frames, s, ss, a, r, done, episode, history=4,
+                 packed_cols=None):
+        """
+        Frame-deduplicated, columnar storage of SARS' transitions.
+        Every preprocessed frame is stored once in frames, and the states S
+        and S' of each transition are rebuilt as stacks of `history`
+        consecutive frames, identified by the index of their most recent frame.
+        Columns are plain typed np.arrays (or memory maps, when loaded from
+        disk), and are exposed without copies.
+        Binarized frames can be stored as bits (see pack), in which case the
+        stacked states are unpacked to frames of 0 and 255.
+        :param frames: np.array of shape (n_frames, rows, cols), uint8
+        :param s: np.array, index of the last frame of S for each transition
+        :param ss: np.array, index of the last frame of S' for each transition
+        :param a: np.array, actions
+        :param r: np.array, rewards
+        :param done: np.array, absorbing flags
+        :param episode: np.array, episode id of each transition
+        :param history: number of frames in a state
+        :param packed_cols: number of columns of the frames, if frames holds
+        binarized frames packed along the columns with np.packbits (None if
+        frames are not packed)
+        """
+        self.frames = frames
+        self.s = s
+        self.ss = ss
+        self.a = a
+        self.r = r
+        self.done = done
+        self.episode = episode
+        self.history = history
+        self.packed_cols = packed_cols
+        self.path = None  # Folder from which the store was loaded
+
+    def __len__(self):
+        return len(self.s)
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in (self.frames, self.s, self.ss, self.a,
+                                      self.r, self.done, self.episode)
+                   if c is not None)
+
+    @property
+    def frame_shape(self):
+        """
+        Shape of the frames of the stacked states (i.e. unpacked)
+        """
+        if self.packed_cols is None:
+            return self.frames.shape[1:]
+        return self.frames.shape[1:-1] + (self.packed_cols,)
+
+    def stack(self, last, out=None):
+        """
+        :param last: np.array, indices of the last frame of each state
+        :param out: np.array in which to write the states
+        :return: np.array of shape (len(last), history, rows, cols) with the
+        stacked states
+        """
+        offsets = np.arange(1 - self.history, 1)
+        indices = np.asarray(last).reshape(-1, 1) + offsets
+        if self.packed_cols is None:
+            return np.take(self.frames, indices, axis=0, out=out)
+
+        # Only the packed bytes of the states are read
+        bits = np.unpackbits(np.take(self.frames, indices, axis=0), axis=-1)
+        bits = bits[..., :self.packed_cols]
+        if out is None:
+            out = np.empty(bits.shape, dtype=np.uint8)
+        np.multiply(bits, 255, out=out)
+        return out
+
+    def S(self, rows=None, out=None):
+        """
+        :param rows: indices of the transitions (all transitions if None)
+        :param out: np.array in which to write the states
+        :return: the stacked states S of the given transitions
+        """
+        return self.stack(self.s if rows is None else self.s[rows], out=out)
+
+    def SS(self, rows=None, out=None):
+        """
+        :param rows: indices of the transitions (all transitions if None)
+        :param out: np.array in which to write the states
+        :return: the stacked states S' of the given transitions
+        """
+        return self.stack(self.ss if rows is None else self.ss[rows], out=out)
+
+    def take(self, rows):
+        """
+        :param rows: indices of the transitions to keep
+        :return: a FrameStore with the given transitions (frames are shared)
+        """
+        return FrameStore(self.frames, self.s[rows], self.ss[rows],
+                          self.a[rows], self.r[rows], self.done[rows],
+                          self.episode[rows], history=self.history,
+                          packed_cols=self.packed_cols)
+
+    def pack(self, binarization_threshold=0.1):
+        """
+        Binarizes the frames with the given threshold (as in
+        deep_rfs.utils.preprocessing.preprocess_states) and packs them in bits,
+        which takes 8 times less space. The states of the packed store are
+        binarized frames of 0 and 255, so they are preprocessed the same way
+        (with or without binarization).
+        :param binarization_threshold: threshold for binarization
+        :return: a FrameStore with packed frames
+        """
+        if self.packed_cols is not None:
+            return self
+        level = binarization_level(binarization_threshold)
+        frames = np.packbits(np.asarray(self.frames) >= level, axis=-1)
+        return FrameStore(frames, self.s, self.ss, self.a, self.r, self.done,
+                          self.episode, history=self.history,
+                          packed_cols=self.frames.shape[-1])
+
+    def save(self, path, codec=None, level=6):
+        """
+        Saves the store as a folder with one typed .npy file for each column,
+        so that it can be memory-mapped when loading.
+        If a codec is given, frames are instead delta-encoded and compressed
+        (see deep_rfs.utils.codec.encode_frames).
+        :param path: path of the folder
+        :param codec: None, 'zlib' or 'lzma'
+        :param level: compression level for the codec
+        """
+        if not path.endswith('/'):
+            path += '/'
+        if not os.path.exists(path):
+            os.makedirs(path)
+        info = {'history': self.history, 'length': len(self), 'codec': codec,
+                'packed_cols': self.packed_cols}
+        for c in COLUMNS:
+            if c == 'frames' and codec is not None:
+                data, offsets = encode_frames(self.frames, codec=codec,
+                                              level=level,
+                                              chunk_size=FRAMES_CHUNK_SIZE)
+                with open(path + 'frames.bin', 'wb') as f:
+                    f.write(data)
+                np.save(path + 'frames_offsets.npy', offsets)
+                info.update({'nb_frames': len(self.frames),
+                             'frame_shape': list(self.frames.shape[1:]),
+                             'chunk_size': FRAMES_CHUNK_SIZE})
+            else:
+                np.save(path + c + '.npy', np.asarray(getattr(self, c), dtype=DTYPES[c]))
+        with open(path + 'store.json', 'w') as f:
+            json.dump(info, f)
+
+    @staticmethod
+    def info(path):
+        """
+        :param path: path of a folder saved with FrameStore.save
+        :return: dict with the history, the number of transitions and the
+        codec of the store
+        """
+        if not path.endswith('/'):
+            path += '/'
+        with open(path + 'store.json') as f:
+            return json.load(f)
+
+    @staticmethod
+    def load(path, mmap_mode='r', n_threads=None, load_frames=True):
+        """
+        Loads a store saved with FrameStore.save. Columns are memory-mapped by
+        default, so no data is read until it is accessed. Compressed frames
+        are decoded in memory using n_threads threads.
+        :param path: path of the folder
+        :param mmap_mode: mmap_mode for np.load (None to read all columns in
+        memory)
+        :param n_threads: number of threads to decode compressed frames (all
+        cores if None)
+        :param load_frames: whether to load the frames (if False, the frames
+        of the store are None, e.g. to read only the actions, rewards and
+        episodes of compressed stores without decoding them)
+        :return: a FrameStore
+        """
+        if not path.endswith('/'):
+            path += '/'
+        info = FrameStore.info(path)
+        columns = []
+        for c in COLUMNS:
+            if c == 'frames' and not load_frames:
+                columns.append(None)
+            elif c == 'frames' and info.get('codec') is not None:
+                with open(path + 'frames.bin', 'rb') as f:
+                    data = f.read()
+                columns.append(decode_frames(data,
+                                             np.load(path + 'frames_offsets.npy'),
+                                             info['nb_frames'],
+                                             info['frame_shape'],
+                                             codec=info['codec'],
+                                             chunk_size=info['chunk_size'],
+                                             n_threads=n_threads))
+            else:
+                columns.append(np.load(path + c + '.npy', mmap_mode=mmap_mode))
+        store = FrameStore(*columns, history=info['history'],
+                           packed_cols=info.get('packed_cols'))
+        store.path = path
+        return store
+
+    @staticmethod
+    def concatenate(stores):
+        """
+        Joins several stores in a single one, remapping frame indices.
+        :param stores: list of FrameStore
+        :return: a FrameStore with all transitions of the given stores
+        """
+        offsets = np.cumsum([0] + [len(st.frames) for st in stores[:-1]])
+        ep_offsets = np.cumsum([0] + [(st.episode.max() + 1) if len(st) else 0
+                                      for st in stores[:-1]])
+        return FrameStore(
+            np.concatenate([st.frames for st in stores]),
+            np.concatenate([st.s + o for st, o in zip(stores, offsets)]),
+            np.concatenate([st.ss + o for st, o in zip(stores, offsets)]),
+            np.concatenate([st.a for st in stores]),
+            np.concatenate([st.r for st in stores]),
+            np.concatenate([st.done for st in stores]),
+            np.concatenate([st.episode + o for st, o in zip(stores, ep_offsets)]),
+            history=stores[0].history,
+            packed_cols=stores[0].packed_cols
+        )
+
+
+class LazyStores:
+    def __init__(self, files, max_decoded=None):
+        """
+        Sequence of the frame stores saved in files, each loaded with
+        FrameStore.load when it is first accessed. Memory-mapped stores are
+        kept open, while at most max_decoded compressed stores (whose frames
+        are decoded in memory) are kept, dropping the least recently used.
+        :param files: paths of the stores
+        :param max_decoded: number of compressed stores kept in memory (all
+        if None)
+        """
+        self.files = files
+        self.max_decoded = max_decoded
+        self.compressed = [FrameStore.info(f).get('codec') is not None
+                           for f in files]
+        self.stores = {}
+        self.decoded = OrderedDict()  # Compressed stores, least recent first
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, i):
+        if not self.compressed[i]:
+            if i not in self.stores:
+                self.stores[i] = FrameStore.load(self.files[i])
+            return self.stores[i]
+
+        if i in self.decoded:
+            store = self.decoded.pop(i)
+        else:
+            store = FrameStore.load(self.files[i])
+            if self.max_decoded is not None:
+                while len(self.decoded) >= max(self.max_decoded, 1):
+                    self.decoded.popitem(last=False)
+        self.decoded[i] = store
+        return store
+
+
+class EpisodeRecorder:
+    def __init__(self, history=4):
+        """
+        Accumulates the frames and transitions of one or more episodes as they
+        are collected, storing each new frame only once.
+        :param history: number of frames in a state
+        """
+        self.history = history
+        self.frames = []
+        self.s = []
+        self.ss = []
+        self.a = []
+        self.r = []
+        self.done = []
+        self.episode = []
+
+    def __len__(self):
+        return len(self.s)
+
+    def add_frames(self, frames):
+        """
+        Stores frames that are not part of a transition (e.g. the most recent
+        frames of an episode which continues from a previous store)
+        :param frames: iterable of np.arrays of shape (rows, cols)
+        """
+        self.frames.extend(frames)
+
+    def append(self, frames, action, reward, next_frames, done, episode_id=0):
+        """
+        Stores a transition as yielded by deep_rfs.utils.datasets.episode
+        :param frames: frames observed before the transition (the last one is
+        the most recent frame of S)
+        :param action: action
+        :param reward: reward
+        :param next_frames: frames observed while executing the action (the
+        last one is the most recent frame of S')
+        :param done: absorbing flag
+        :param episode_id: id of the episode of the transition
+        """
+        self.frames.extend(frames)
+        self.s.append(len(self.frames) - 1)
+        self.frames.extend(next_frames)
+        self.ss.append(len(self.frames) - 1)
+        self.a.append(action)
+        self.r.append(reward)
+        self.done.append(done)
+        self.episode.append(episode_id)
+
+    def to_store(self):
+        """
+        :return: a FrameStore with the recorded transitions
+        """
+        return FrameStore(np.asarray(self.frames, dtype=DTYPES['frames']),
+                          np.asarray(self.s, dtype=DTYPES['s']),
+                          np.asarray(self.ss, dtype=DTYPES['ss']),
+                          np.asarray(self.a, dtype=DTYPES['a']),
+                          np.asarray(self.r, dtype=DTYPES['r']),
+                          np.asarray(self.done, dtype=DTYPES['done']),
+                          np.asarray(self.episode, dtype=DTYPES['episode']),
+                          history=self.history)
+
+
+class ShardWriter:
+    def __init__(self, path, shard_size, base_block=0, history=4,
+                 shuffle=False, codec=None, binarization_threshold=None,
+                 base_episode=0, update_manifest=True):
+        """
+        Streams SARS' transitions to fixed-size FrameStore shards in path
+        ('sars_<block>/' folders). A shard is saved as soon as it holds
+        shard_size transitions, so only one shard is kept in memory, and its
+        summary is added to the manifest of the dataset.
+        :param path: folder in which to save the shards
+        :param shard_size: number of transitions in each shard
+        :param base_block: index of the first shard
+        :param history: number of frames in a state
+        :param shuffle: whether to shuffle the transitions of each shard
+        before saving it
+        :param codec: compression codec for the frames (see FrameStore.save)
+        :param binarization_threshold: if given, frames are binarized with
+        this threshold and saved as bits (see FrameStore.pack)
+        :param base_episode: id of the first episode
+        :param update_manifest: whether to add the summaries of the shards to
+        the manifest (they are kept in self.summaries in any case, e.g. for
+        writers running in parallel processes)
+        """
+        if not path.endswith('/'):
+            path += '/'
+        try:
+            os.makedirs(path)
+        except OSError as e:  # The folder exists (e.g. created by another writer)
+            if e.errno != errno.EEXIST:
+                raise
+        self.path = path
+        self.shard_size = shard_size
+        self.block = base_block
+        self.history = history
+        self.shuffle = shuffle
+        self.codec = codec
+        self.binarization_threshold = binarization_threshold
+        self.update_manifest = update_manifest
+        self.summaries = []
+        self.nb_samples = 0
+        self.episode_id = base_episode
+        self.recorder = EpisodeRecorder(history=history)
+        self.context = None  # Last frames of an episode split across shards
+
+    def append(self, frames, action, reward, next_frames, done):
+        """
+        Adds a transition (as yielded by deep_rfs.utils.datasets.episode) of
+        the current episode to the shard, saving the shard if it is full.
+        """
+        if self.context is not None:
+            self.recorder.add_frames(self.context)
+            self.context = None
+        self.recorder.append(frames, action, reward, next_frames, done,
+                             episode_id=self.episode_id)
+        self.nb_samples += 1
+        if len(self.recorder) == self.shard_size:
+            self.flush()
+
+    def end_episode(self):
+        """
+        Marks the end of the current episode.
+        """
+        self.episode_id += 1
+        self.context = None
+
+    def flush(self):
+        """
+        Saves the current shard to disk (if it is not empty).
+        """
+        if len(self.recorder) == 0:
+            return
+        store = self.recorder.to_store()
+        # The next transition of the episode starts from these frames
+        context = list(store.frames[-self.history:])
+
+        if self.shuffle:
+            store = store.take(np.random.permutation(len(store)))
+        if self.binarization_threshold is not None:
+            store = store.pack(self.binarization_threshold)
+        store.save(self.path + 'sars_%s/' % self.block, codec=self.codec)
+        name = 'sars_%s' % self.block
+        self.summaries.append(summarize(store, name))
+        if self.update_manifest:
+            add_summaries(self.path, self.summaries[-1:], self.history)
+        self.block += 1
+
+        self.context = context
+        self.recorder = EpisodeRecorder(history=self.history)
+
+    def close(self):
+        """
+        Saves the last, partially filled shard.
+        """
+        self.flush()
+        self.context = None
@@ -2,7 +2,8 @@ from __future__ import print_function
 
 import numpy as np
 import pandas as pd
-from PIL import Image
+
+from deep_rfs.utils.preprocessing import resize_nearest
 
 
 def resize_state(to_resize, new_size=(72, 72)):
@@ -12,12 +13,9 @@ def resize_state(to_resize, new_size=(72, 72)):
     :param new_size: the size to which resize the images
     :return: a numpy array with the resized images
     """
-    # Iterate over channels (th dimension ordering (ch, rows, cols) is assumed)
-    resized = []
-    for image in to_resize:
-        data = Image.fromarray(image).resize(new_size)
-        resized.append(np.asarray(data))
-    return np.asarray(resized).squeeze()
+    # Resize all channels at once (th dimension ordering (ch, rows, cols) is
+    # assumed, new_size is (cols, rows) like in PIL)
+    return resize_nearest(np.asarray(to_resize), new_size[::-1]).squeeze()
 
 
 def flat2gen(alist):
@@ -60,8 +58,8 @@ def pds_to_npa(object_array):
 
 def get_size(structures, unit='B'):
     """
-    Returns the approximated size of all pandas dataframes or np.arrays in the
-    given list.
+    Returns the approximated size of all pandas dataframes, np.arrays or
+    FrameStores in the given list.
     :param structures: the objects to measure 
     :param unit: str, the size unit to use
     :return: the memory footprint of the given structures
@@ -73,9 +71,9 @@ def get_size(structures, unit='B'):
                'TB': 1099511627776.}
     size = 0.
     for s in structures:
-        if isinstance(s, np.ndarray):
-            size += s.nbytes
-        elif isinstance(s, pd.DataFrame) or isinstance(s, pd.Series):
+        if isinstance(s, pd.DataFrame) or isinstance(s, pd.Series):
             size += s.memory_usage(index=True, deep=True).sum()
+        elif hasattr(s, 'nbytes'):
+            size += s.nbytes
 
     return size / factors[unit]
@@ -0,0 +1,126 @@
+import json
+import os
+
+import numpy as np
+
+MANIFEST = 'manifest.json'
+INDEX = 'index.npy'
+
+
+def block_number(name):
+    """
+    :param name: name (or path) of a 'sars_<block>' store
+    :return: the block number of the store
+    """
+    return int(name.rstrip('/').rsplit('_', 1)[-1])
+
+
+def shard_path(path, shard):
+    """
+    :param path: dataset folder
+    :param shard: the summary of a shard in the manifest of the dataset
+    :return: the folder of the shard, which is either in the dataset folder
+    or, for aggregated datasets, in the folder of the dataset it comes from
+    """
+    if 'source' in shard:
+        return shard['source']
+    if not path.endswith('/'):
+        path += '/'
+    return path + shard['name']
+
+
+def _counts(values):
+    keys, counts = np.unique(np.asarray(values), return_counts=True)
+    return dict((repr(k.item()), int(c)) for k, c in zip(keys, counts))
+
+
+def summarize(store, name):
+    """
+    Computes the statistics of a FrameStore that are kept in the manifest.
+    :param store: a FrameStore
+    :param name: name of the store folder in the dataset
+    :return: a dict with the number of rows and frames, the reward histogram,
+    the action counts, the number of absorbing transitions and the first row
+    and number of rows of each episode (rows of an episode are contiguous
+    unless the store was shuffled)
+    """
+    episodes, first, nb_rows = np.unique(np.asarray(store.episode),
+                                         return_index=True, return_counts=True)
+    return {'name': name,
+            'rows': len(store),
+            'frames': len(store.frames),
+            'rewards': _counts(store.r),
+            'actions': _counts(store.a),
+            'done': int(np.count_nonzero(store.done)),
+            'episodes': dict((str(e), [int(f), int(n)])
+                             for e, f, n in zip(episodes, first, nb_rows))}
+
+
+def load_manifest(path):
+    """
+    :param path: dataset folder
+    :return: the manifest of the dataset as a dict, or None if the dataset has
+    no manifest
+    """
+    if not path.endswith('/'):
+        path += '/'
+    if not os.path.exists(path + MANIFEST):
+        return None
+    with open(path + MANIFEST) as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    """
+    Writes the manifest of a dataset (atomically, so that readers never see
+    a partially written file).
+    :param path: dataset folder
+    :param manifest: the manifest as a dict
+    """
+    if not path.endswith('/'):
+        path += '/'
+    with open(path + MANIFEST + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.rename(path + MANIFEST + '.tmp', path + MANIFEST)
+
+
+def add_shard(path, name, store):
+    """
+    Adds (or replaces) the summary of a store in the manifest of a dataset.
+    :param path: dataset folder
+    :param name: name of the store folder in the dataset
+    :param store: the FrameStore saved in path + name
+    """
+    add_summaries(path, [summarize(store, name)], store.history)
+
+
+def add_summaries(path, summaries, history):
+    """
+    Adds (or replaces) shard summaries in the manifest of a dataset, e.g. the
+    summaries of shards saved by several processes.
+    :param path: dataset folder
+    :param summaries: list of shard summaries (see summarize)
+    :param history: number of frames in a state
+    """
+    manifest = load_manifest(path) or {'history': history, 'shards': []}
+    names = set(s['name'] for s in summaries)
+    shards = [s for s in manifest['shards'] if s['name'] not in names]
+    shards.extend(summaries)
+    shards.sort(key=lambda s: block_number(s['name']))
+    manifest['shards'] = shards
+    save_manifest(path, manifest)
+
+
+def total_counts(manifest, key):
+    """
+    :param manifest: the manifest of a dataset
+    :param key: 'rewards' or 'actions'
+    :return: dict with the counts of each value in the whole dataset, with
+    float (rewards) or int (actions) keys
+    """
+    cast = float if key == 'rewards' else int
+    counts = dict()
+    for shard in manifest['shards']:
+        for k, c in shard[key].items():
+            counts[cast(k)] = counts.get(cast(k), 0) + c
+    return counts
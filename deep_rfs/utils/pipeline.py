@@ -0,0 +1,101 @@
+import sys
+import threading
+from collections import deque
+
+try:
+    from Queue import Queue, Empty, Full
+except ImportError:  # Python 3
+    from queue import Queue, Empty, Full
+
+_POLL = 0.1  # Seconds between checks of the stop flag
+
+
+def _put(queue, item, stop):
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=_POLL)
+            return True
+        except Full:
+            pass
+    return False
+
+
+def _get(queue, stop):
+    while not stop.is_set():
+        try:
+            return True, queue.get(timeout=_POLL)
+        except Empty:
+            pass
+    return False, None
+
+
+def prefetch(jobs, load, n_workers=2, queue_size=8, hold=1):
+    """
+    Runs load(job, buffers) on the jobs of a generator with a pool of worker
+    threads, and yields the results through a bounded queue.
+    Each call to load receives a dict of buffers that it can fill lazily and
+    return views of: buffers are recycled once the consumer has requested
+    `hold` more results, so the batches that are still in use must not be
+    more than hold (e.g. Keras's max_q_size + 2 when the generator is passed
+    to fit_generator).
+    NumPy copies, casts and arithmetic, as well as zlib decompression, release
+    the GIL, so loading overlaps with training.
+    Results may be yielded in a different order than the jobs when
+    n_workers > 1.
+
+    :param jobs: generator of jobs (e.g. the segments of batch_segments)
+    :param load: function (job, buffers) -> result
+    :param n_workers: number of worker threads
+    :param queue_size: number of results prefetched in the queue
+    :param hold: number of yielded results whose buffers are not recycled
+    :return: a generator of results
+    """
+    stop = threading.Event()
+    job_queue = Queue(maxsize=queue_size)
+    result_queue = Queue(maxsize=queue_size)
+    free_buffers = Queue()
+    for _ in range(queue_size + n_workers + hold + 1):
+        free_buffers.put({})
+
+    def feed():
+        try:
+            for job in jobs:
+                if not _put(job_queue, job, stop):
+                    return
+        except Exception:
+            _put(result_queue, (None, None, sys.exc_info()), stop)
+
+    def work():
+        while True:
+            got_job, job = _get(job_queue, stop)
+            if not got_job:
+                return
+            got_buffers, buffers = _get(free_buffers, stop)
+            if not got_buffers:
+                return
+            try:
+                result = (load(job, buffers), buffers, None)
+            except Exception:
+                result = (None, None, sys.exc_info())
+            if not _put(result_queue, result, stop):
+                return
+
+    threads = [threading.Thread(target=feed)]
+    threads += [threading.Thread(target=work) for _ in range(n_workers)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+
+    in_use = deque()
+    try:
+        while True:
+            result, buffers, error = result_queue.get()
+            if error is not None:
+                # Re-raised with the traceback of the thread that failed
+                raise error[0], error[1], error[2]
+            yield result
+            in_use.append(buffers)
+            if len(in_use) > hold:
+                free_buffers.put(in_use.popleft())
+    finally:
+        stop.set()
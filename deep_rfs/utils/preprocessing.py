@@ -0,0 +1,130 @@
+import numpy as np
+
+# Fixed point (16 bit) ITU-R 601-2 luma weights, as used by PIL's convert('L')
+LUMA_WEIGHTS = (19595, 38470, 7471)
+
+
+def nearest_indices(in_size, out_size):
+    """
+    Computes the source pixels of a nearest-neighbour resize along one axis
+    (the same pixels as PIL's resize with the NEAREST filter).
+    :param in_size: number of pixels of the input
+    :param out_size: number of pixels of the output
+    :return: np.array with the index of the input pixel of each output pixel
+    """
+    scale = in_size / float(out_size)
+    # Accumulate the pixel centers like PIL, so that ties are rounded the same
+    centers = np.cumsum(np.r_[0.5 * scale, np.full(out_size - 1, scale)])
+    return centers.astype(np.intp)
+
+
+def resize_nearest(images, shape):
+    """
+    Resizes greyscale images with nearest-neighbour interpolation.
+    :param images: np.array of shape (..., rows, cols)
+    :param shape: (rows, cols) of the resized images
+    :return: np.array of shape (..., shape[0], shape[1])
+    """
+    rows = nearest_indices(images.shape[-2], shape[0])
+    cols = nearest_indices(images.shape[-1], shape[1])
+    return images[..., rows[:, None], cols]
+
+
+class FramePreprocessor:
+    def __init__(self, in_shape, out_shape, crop=None):
+        """
+        Converts RGB frames to greyscale and resizes them (nearest-neighbour),
+        equivalently to PIL's convert('L') followed by resize, but only
+        converting the pixels that are kept, with precomputed index tables.
+        :param in_shape: (rows, cols) of the RGB frames
+        :param out_shape: (rows, cols) of the resized frames
+        :param crop: (first, last) rows of the resized frames to keep (all if
+        None)
+        """
+        self.rows = nearest_indices(in_shape[0], out_shape[0])
+        self.cols = nearest_indices(in_shape[1], out_shape[1])
+        if crop is not None:
+            self.rows = self.rows[crop[0]:crop[1]]
+        self.shape = (len(self.rows), len(self.cols))
+        # Index of each kept pixel in the flattened frames
+        self.pixels = (self.rows[:, None] * in_shape[1] + self.cols).ravel()
+
+    def __call__(self, frames, out=None):
+        """
+        :param frames: np.array of shape (rows, cols, 3) or (n, rows, cols, 3),
+        uint8 RGB frames
+        :param out: uint8 np.array in which to write the preprocessed frames
+        :return: np.array of shape self.shape or (n,) + self.shape, uint8
+        """
+        frames = np.asarray(frames)
+        batch_shape = frames.shape[:-3]
+        pixels = frames.reshape(batch_shape + (-1, 3)).take(self.pixels, axis=-2)
+        pixels = pixels.astype(np.uint32)
+        luma = pixels[..., 0] * LUMA_WEIGHTS[0]
+        luma += pixels[..., 1] * LUMA_WEIGHTS[1]
+        luma += pixels[..., 2] * LUMA_WEIGHTS[2]
+        luma += 0x8000  # Round to nearest
+        luma >>= 16
+        luma = luma.reshape(batch_shape + self.shape)
+        if out is None:
+            return luma.astype(np.uint8)
+        out[...] = luma
+        return out
+
+
+def state_lut(binarize=False, binarization_threshold=0.1):
+    """
+    :param binarize: whether to convert states to a {0, 1} binary space
+    :param binarization_threshold: threshold for binarization (on the 0-1
+    range)
+    :return: 256-entry float32 np.array with the preprocessed value of each
+    uint8 pixel value
+    """
+    lut = np.arange(256, dtype=np.float32) / 255.  # To 0-1 range
+    if binarize:
+        lut = (lut >= binarization_threshold).astype(np.float32)
+    return lut
+
+
+def binarization_level(binarization_threshold=0.1):
+    """
+    :param binarization_threshold: threshold for binarization (on the 0-1
+    range)
+    :return: the smallest uint8 pixel value that is binarized to 1 (256 if
+    none is)
+    """
+    ones = np.flatnonzero(state_lut(True, binarization_threshold))
+    return ones[0] if len(ones) > 0 else 256
+
+
+def preprocess_states(x, binarize=False, binarization_threshold=0.1, rows=108,
+                      out=None):
+    """
+    Converts uint8 states to the float32 input of the encoders (see
+    state_lut) in a single pass over the output, cropping the oldest rows of
+    the frames if they are taller than `rows`.
+    Binarization is a comparison of the uint8 pixels with the smallest value
+    that state_lut maps to 1, so no float temporaries are allocated.
+    :param x: np.array of shape (n, history, frame_rows, cols), uint8 states
+    :param binarize: whether to convert states to a {0, 1} binary space
+    :param binarization_threshold: threshold for binarization
+    :param rows: number of rows of the frames to keep (all if None)
+    :param out: float32 np.array in which to write the preprocessed states
+    (e.g. a reusable batch buffer)
+    :return: the preprocessed states
+    """
+    x = np.asarray(x)
+    if rows is not None and x.shape[-2] > rows:
+        x = x[..., x.shape[-2] - rows:, :]
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+    else:
+        out = out[:len(x)]
+
+    if binarize:
+        np.greater_equal(x, binarization_level(binarization_threshold),
+                         out=out, casting='unsafe')
+    else:
+        out[...] = x
+        np.divide(out, 255., out=out)  # To 0-1 range
+    return out
@@ -6,19 +6,24 @@ import joblib
 import gc
 import argparse
 import atexit
+import functools
 from sklearn.ensemble import ExtraTreesRegressor
 from sklearn.linear_model import LinearRegression
 from xgboost import XGBRegressor
 from deep_rfs.envs.atari import Atari
+from deep_rfs.envs.synthetic import SyntheticAtari
+from deep_rfs.envs.vector import VectorEnv
 from deep_rfs.evaluation.evaluation import *
 from deep_rfs.extraction.Autoencoder import Autoencoder
 from deep_rfs.models.epsilonFQI import EpsilonFQI
+from deep_rfs.models.inference import InferenceServer
 from deep_rfs.selection.ifs import IFS
 from deep_rfs.selection.rfs import RFS
+from deep_rfs.utils.collection import CollectionPool
 from deep_rfs.utils.datasets import *
+from deep_rfs.utils.feature_cache import FeatureCache
 from deep_rfs.utils.Logger import Logger
 from deep_rfs.utils.timer import *
-from deep_rfs.utils.helpers import get_size
 from ifqi.models import Regressor, ActionRegressor
 from sklearn.neural_network import MLPRegressor
 
@@ -52,7 +57,7 @@ parser.add_argument('-d', '--debug', action='store_true', help='Run in debug mod
 parser.add_argument('--main-alg-iters', type=int, default=1, help='Number of main algorithm steps to run (by default runs in full batch mode)')
 
 # MDP
-parser.add_argument('-e', '--env', type=str, default='BreakoutDeterministic-v4', help='Atari environment on which to run the algorithm')
+parser.add_argument('-e', '--env', type=str, default='BreakoutDeterministic-v4', help='Atari environment on which to run the algorithm (SyntheticBreakout for a synthetic environment that does not need the ROMs)')
 parser.add_argument('--clip', action='store_true', help='Clip reward of MDP')
 parser.add_argument('--clip-eval', action='store_true', help='Clip reward of MDP during evaluation')
 
@@ -67,6 +72,9 @@ parser.add_argument('--use-vae', action='store_true', help='Use VAE instead of u
 parser.add_argument('--vae-beta', type=float, default=1., help='Beta hyperparameter for Beta-VAE')
 parser.add_argument('--use-dense', action='store_true', help='Use AE with dense inner layer instead of usual AE')
 parser.add_argument('--dropout', type=float, default=0., help='Dropout rate for dense AE')
+parser.add_argument('--ae-input-workers', type=int, default=0, help='Number of threads that prefetch and preprocess AE batches (0 to load them serially)')
+parser.add_argument('--ae-stratify', action='store_true', help='Train the AE on reward-balanced epochs with importance weights')
+parser.add_argument('--ae-epoch-samples', type=int, default=None, help='Number of samples in a reward-balanced AE epoch (size of the dataset by default)')
 parser.add_argument('--n-features', type=int, default=128, help='Number of features for contractive, dense and VAE')
 
 # RFS
@@ -83,19 +91,36 @@ parser.add_argument('--fqi-iter', type=int, default=5000, help='Number of FQI it
 parser.add_argument('--fqi-eval-episodes', type=int, default=2, help='Number of episodes to evaluate FQI')
 parser.add_argument('--fqi-eval-period', type=int, default=1, help='Number of FQI iterations after which to evaluate')
 parser.add_argument('--save-video', action='store_true', help='Save the gifs of the evaluation episodes')
+parser.add_argument('--eval-envs', type=int, default=1, help='Number of environments that run the evaluation episodes in lockstep, with batched action selection')
 parser.add_argument('--fqi-test-after-loading', action='store_true', help='Test FQI after loading it')
 
 # Dataset collection
 parser.add_argument('--load-sars', type=str, default=None, help='Path to dataset folder to use instead of collecting')
 parser.add_argument('--sars-samples', type=int, default=500000, help='Number of SARS samples to collect')
 parser.add_argument('--sars-blocks', type=int, default=25, help='Number of SARS episodes to collect to disk')
-parser.add_argument('--sars-test-episodes', type=int, default=100, help='Number of SARS test episodes to collect')
-parser.add_argument('--force-valid-sars', action='store_true', help='Force the collection of a validation SARS')
+parser.add_argument('--valid-fraction', type=float, default=0.1, help='Fraction of the episodes of the SARS dataset held out to validate the AE')
+parser.add_argument('--valid-samples', type=int, default=None, help='Validate the AE on a fixed random subsample of the held out transitions (all by default)')
+parser.add_argument('--sars-codec', type=str, default=None, choices=['zlib', 'lzma'], help='Compress the frames of the SARS dataset with the given codec')
+parser.add_argument('--pack-sars', action='store_true', help='Store the binarized frames of the SARS dataset as bits (requires --binarize)')
+parser.add_argument('--aggregate-sars', action='store_true', help='Train on the SARS datasets of all iterations instead of only the last one')
+parser.add_argument('--aggregate-max-samples', type=int, default=None, help='Maximum number of SARS samples kept when aggregating datasets (unbounded by default)')
+parser.add_argument('--aggregate-eviction', type=str, default='reservoir', choices=['fifo', 'reservoir'], help='Which samples to drop when the aggregated dataset exceeds --aggregate-max-samples')
+parser.add_argument('--aggregate-recency', type=float, default=1., help='Weight of newer samples for reservoir eviction (1 keeps a uniform sample of all iterations)')
+parser.add_argument('--collect-workers', type=int, default=0, help='Number of processes that collect the SARS shards in parallel, each with its own environment (0 to collect serially)')
+parser.add_argument('--inference-server', action='store_true', help='Select the greedy actions of the collection workers in batches in the main process, instead of loading the policy in each worker (requires --collect-workers)')
 parser.add_argument('--control-freq', type=int, default=1, help='Control refrequency (1 action every n steps)')
+parser.add_argument('--env-repeat', action='store_true', help='Repeat actions inside the Atari env for --control-freq steps, observing only the last frame (also during evaluation)')
+parser.add_argument('--max-pool-frames', action='store_true', help='Max-pool the last two frames of the actions repeated by the Atari env')
 parser.add_argument('--save-FARF', action='store_true', help='Save the F, A, R, FF arrays')
 parser.add_argument('--load-FARF', type=str, default=None, help='Load the F, A, R, FF arrays')
+parser.add_argument('--feature-cache', type=str, default=None, help='Folder in which to cache the AE features of the SARS dataset across iterations and runs')
+parser.add_argument('--feature-cache-size', type=float, default=None, help='Size budget of the feature cache in GB (unbounded by default)')
 
 args = parser.parse_args()
+if args.pack_sars and not args.binarize:
+    parser.error('--pack-sars requires --binarize')
+if args.inference_server and args.collect_workers == 0:
+    parser.error('--inference-server requires --collect-workers')
 
 # Parameters
 # Env
@@ -105,6 +130,7 @@ initial_actions = [1]  # Initial actions
 nn_nb_epochs = 5 if args.debug else args.ae_epochs  # Number of training epochs for AE
 nn_batch_size = 6 if args.debug else 32  # Number of samples in a batch for AE
 nn_binarization_threshold = 0.35 if args.env == 'PongDeterministic-v4' else 0.1
+nn_max_q_size = 10 if args.ae_input_workers > 0 else 250  # Size of Keras's batch queue
 
 # RFS
 ifs_nb_trees = 50  # Number of trees to use in IFS
@@ -132,22 +158,59 @@ logger = Logger(output_folder='../output/', custom_run_name=custom_run_name)
 setup_logging(logger.path + 'log.txt')
 
 # Environment
-mdp = Atari(args.env, clip_reward=args.clip)
+env_repeat = args.control_freq if args.env_repeat else 1  # Repeat of the Atari env
+collection_repeat = 1 if args.env_repeat else args.control_freq  # Repeat of the collection
+if args.env == 'SyntheticBreakout':
+    make_env = functools.partial(SyntheticAtari, clip_reward=args.clip,
+                                 repeat=env_repeat, max_pool=args.max_pool_frames)
+else:
+    make_env = functools.partial(Atari, args.env, clip_reward=args.clip,
+                                 repeat=env_repeat, max_pool=args.max_pool_frames)
+mdp = make_env()
 action_values = mdp.action_space.values
+if args.eval_envs > 1:
+    if args.save_video:
+        parser.error('--eval-envs does not support --save-video')
+    eval_mdp = VectorEnv([make_env() for _ in range(args.eval_envs)])
+else:
+    eval_mdp = mdp
+
+# AE parameters (shared with the collection workers)
+ae_params = {'n_features': args.n_features,
+             'batch_size': nn_batch_size,
+             'nb_epochs': nn_nb_epochs,
+             'binarize': args.binarize,
+             'binarization_threshold': nn_binarization_threshold,
+             'use_vae': args.use_vae,
+             'beta': args.vae_beta,
+             'use_dense': args.use_dense,
+             'dropout_prob': args.dropout}
+
+
+def make_collection_policy(fqi):
+    return EpsilonFQI(fqi, Autoencoder((4, 108, 84), **ae_params))
+
+
+# Collection workers (forked before building any Keras model)
+if args.inference_server:
+    inference_server = InferenceServer(n_clients=args.collect_workers)
+else:
+    inference_server = None
+if args.collect_workers > 0:
+    collection_pool = CollectionPool(make_env,
+                                     make_policy=make_collection_policy,
+                                     n_workers=args.collect_workers,
+                                     server=inference_server,
+                                     actions=action_values)
+    atexit.register(collection_pool.close)
+else:
+    collection_pool = None
 
 # Autoencoder (this one will be used as FE, but never trained)
 ae = Autoencoder((4, 108, 84),
-                 n_features=args.n_features,
-                 batch_size=nn_batch_size,
-                 nb_epochs=nn_nb_epochs,
-                 binarize=args.binarize,
-                 binarization_threshold=nn_binarization_threshold,
                  logger=logger,
                  ckpt_file='autoencoder_ckpt_0.h5',
-                 use_vae=args.use_vae,
-                 beta=args.vae_beta,
-                 use_dense=args.use_dense,
-                 dropout_prob=args.dropout)
+                 **ae_params)
 ae.model.summary()
 if args.load_ae is None:
     support = np.array([True] * ae.get_features_number())  # Keep all features
@@ -159,6 +222,13 @@ else:
         support = np.array([True] * ae.get_features_number())  # Keep all features
 ae.set_support(support)
 
+# Feature cache
+if args.feature_cache is not None:
+    feature_cache = FeatureCache(args.feature_cache,
+                                 max_bytes=None if args.feature_cache_size is None else int(args.feature_cache_size * 1e9))
+else:
+    feature_cache = None
+
 # Create EpsilonFQI
 if args.load_fqi is None:
     # Don't care, will only be used as fully random policy and never trained
@@ -180,7 +250,7 @@ else:
 
     if args.fqi_test_after_loading:
         # Evaluate policy after loading
-        partial_eval = evaluate_policy(mdp,
+        partial_eval = evaluate_policy(eval_mdp,
                                        policy,
                                        n_episodes=5,
                                        initial_actions=initial_actions,
@@ -197,50 +267,71 @@ loc = locals().copy()
 log('\n'.join(['%s, %s' % (k, v) for k, v in loc.iteritems()
                if not str(v).startswith('<')]) + '\n')
 
+aggregated_sars_path = logger.path + 'sars_aggregated/'
 log('######## START ########')
 for main_alg_iter in range(args.main_alg_iters):
     if args.load_sars is None or main_alg_iter > 0:
         tic('Collecting SARS dataset')
         sars_path = logger.path + 'sars_%s/' % main_alg_iter
+        if inference_server is not None:
+            inference_server.policy = policy
+        elif collection_pool is not None and policy.get_epsilon() < 1:
+            # Send the current policy to the workers
+            policy.save_fqi(logger.path + 'collection_fqi.pkl')
+            ae.model.save_weights(logger.path + 'collection_ae.h5')
+            collection_pool.update_policy(fqi=logger.path + 'collection_fqi.pkl',
+                                          weights=logger.path + 'collection_ae.h5',
+                                          support=support)
         samples_in_dataset = collect_sars_to_disk(mdp,
                                                   policy,
                                                   sars_path,
                                                   samples=args.sars_samples,
                                                   blocks=args.sars_blocks,
+                                                  base_block=next_block(aggregated_sars_path) if args.aggregate_sars else 0,
                                                   debug=args.debug,
                                                   random_episodes_pctg=0.0,
                                                   initial_actions=initial_actions,
-                                                  repeat=args.control_freq,
+                                                  repeat=collection_repeat,
                                                   batch_size=nn_batch_size,
-                                                  shuffle=False)
+                                                  shuffle=False,
+                                                  codec=args.sars_codec,
+                                                  binarization_threshold=nn_binarization_threshold if args.pack_sars else None,
+                                                  pool=collection_pool)
     else:
         tic('Loading SARS dataset from disk')
         sars_path = args.load_sars
         samples_in_dataset = get_nb_samples_from_disk(sars_path)
     toc('Got %s SARS\' samples' % samples_in_dataset)
+    if inference_server is not None:
+        log('Inference server: %s' % inference_server.stats(reset=True))
+
+    # Dataset on which to train the AE, select features and run FQI
+    if args.aggregate_sars:
+        tic('Aggregating SARS datasets')
+        dataset_path = aggregated_sars_path
+        samples_in_dataset = aggregate_sars(dataset_path,
+                                            [sars_path],
+                                            max_samples=args.aggregate_max_samples,
+                                            eviction=args.aggregate_eviction,
+                                            recency=args.aggregate_recency)
+        toc('Got %s aggregated SARS\' samples' % samples_in_dataset)
+    else:
+        dataset_path = sars_path
 
     if args.train_ae or main_alg_iter > 0:
-        # Collect test dataset
-        if args.load_sars is None or args.force_valid_sars:
-            tic('Collecting test SARS dataset')
-            test_sars = collect_sars(mdp,
-                                     policy,
-                                     episodes=args.sars_test_episodes,
-                                     debug=args.debug,
-                                     random_episodes_pctg=0.0,
-                                     initial_actions=initial_actions,
-                                     repeat=args.control_freq,
-                                     shuffle=False)
-            np.save(sars_path + 'valid_sars.npy', test_sars)
-        else:
-            tic('Loading test SARS from disk')
-            test_sars = np.load(sars_path + 'valid_sars.npy')
-
-        test_S = pds_to_npa(test_sars[:, 0])
-        toc('Got %s test SARS\' samples' % len(test_sars))
-
-        log('Memory usage (test_sars, test_S): %s MB\n' %
-            get_size([test_sars, test_S, ae], 'MB'))
+        # Hold out the validation episodes
+        tic('Splitting SARS dataset by episode')
+        train_idx, valid_idx = split_episodes(dataset_path, valid_fraction=args.valid_fraction)
+        if len(valid_idx) == 0:
+            # Single episode (e.g. with --debug): hold out random transitions
+            # instead, since checkpoints are selected on the validation loss
+            print 'Warning: one episode in the dataset, splitting by transition'
+            train_idx = np.random.permutation(train_idx)
+            nb_valid = max(1, int(round(len(train_idx) * args.valid_fraction)))
+            train_idx, valid_idx = np.sort(train_idx[nb_valid:]), np.sort(train_idx[:nb_valid])
+        if args.valid_samples is not None and args.valid_samples < len(valid_idx):
+            valid_idx = np.sort(np.random.choice(valid_idx, args.valid_samples, replace=False))
+        toc('Got %s training and %s validation SARS\' samples' % (len(train_idx), len(valid_idx)))
 
         if args.load_ae is not None or main_alg_iter > 0:
             # Reset AE after collecting samples with old AE
@@ -261,25 +352,44 @@ for main_alg_iter in range(args.main_alg_iters):
         tic('Fitting Autoencoder')
         if args.use_sw:
             tic('Getting class weights')
-            cw = get_class_weight_from_disk(sars_path, clip=args.clip)
+            cw = get_class_weight_from_disk(dataset_path, clip=args.clip)
             toc(cw)
         else:
             cw = None
-        ss_generator = ss_generator_from_disk(sars_path,
+        ss_generator = ss_generator_from_disk(dataset_path,
                                               ae,
                                               batch_size=nn_batch_size,
                                               binarize=args.binarize,
                                               binarization_threshold=nn_binarization_threshold,
                                               weights=cw,
                                               shuffle=True,
-                                              clip=args.clip)
+                                              clip=args.clip,
+                                              n_workers=args.ae_input_workers,
+                                              hold=nn_max_q_size + 2,
+                                              stratify=args.ae_stratify,
+                                              epoch_size=args.ae_epoch_samples,
+                                              subset=train_idx)
+        valid_generator = ss_generator_from_disk(dataset_path,
+                                                 ae,
+                                                 batch_size=nn_batch_size,
+                                                 binarize=args.binarize,
+                                                 binarization_threshold=nn_binarization_threshold,
+                                                 clip=args.clip,
+                                                 hold=nn_max_q_size + 2,
+                                                 subset=valid_idx)
+        if args.ae_stratify and args.ae_epoch_samples is not None:
+            ae_epoch_samples = args.ae_epoch_samples
+        else:
+            ae_epoch_samples = len(train_idx)
         ae.fit_generator(ss_generator,
-                         samples_in_dataset / nn_batch_size,
+                         int(np.ceil(ae_epoch_samples / float(nn_batch_size))),
                          nn_nb_epochs,
-                         validation_data=(test_S, test_S))
+                         validation_data=valid_generator,
+                         validation_steps=int(np.ceil(len(valid_idx) / float(nn_batch_size))),
+                         max_q_size=nn_max_q_size)
         ae.load(logger.path + 'autoencoder_ckpt_%s.h5' % main_alg_iter)
 
-        del test_sars, test_S
+        del ss_generator, valid_generator
         gc.collect()
         toc()
 
@@ -287,7 +397,7 @@ for main_alg_iter in range(args.main_alg_iters):
         # Feature selection
         if args.load_FARF is None:
             tic('Building FARF dataset for FS')
-            F, A, R, FF = build_farf_from_disk(ae, sars_path, shuffle=True)
+            F, A, R, FF = build_farf_from_disk(ae, dataset_path, shuffle=True, cache=feature_cache)
             if args.save_FARF:
                 joblib.dump((F, A, R, FF), logger.path + 'RFS_F_A_R_F_%s.pkl' % main_alg_iter)
         else:
@@ -354,7 +464,7 @@ for main_alg_iter in range(args.main_alg_iters):
     # Build dataset for FQI
     if args.fqi_load_faft is None:
         tic('Building dataset for FQI')
-        faft, r, action_values = build_faft_r_from_disk(ae, sars_path, shuffle=True)
+        faft, r, action_values = build_faft_r_from_disk(ae, dataset_path, shuffle=True, cache=feature_cache)
         # Save dataset
         log('Saving dataset')
         joblib.dump((faft, r, action_values), logger.path + 'FQI_FAFT_R_action_values_%s.pkl' % main_alg_iter)
@@ -424,7 +534,7 @@ for main_alg_iter in range(args.main_alg_iters):
         policy.partial_fit()
         if partial_iter % args.fqi_eval_period == 0 or partial_iter == (args.fqi_iter-1):
             print 'Eval...'
-            partial_eval = evaluate_policy(mdp,
+            partial_eval = evaluate_policy(eval_mdp,
                                            policy,
                                            n_episodes=args.fqi_eval_episodes,
                                            initial_actions=initial_actions,
@@ -447,7 +557,7 @@ for main_alg_iter in range(args.main_alg_iters):
 
     # Final evaluation
     tic('Evaluating best policy after update')
-    final_eval = evaluate_policy(mdp,
+    final_eval = evaluate_policy(eval_mdp,
                                  policy,
                                  n_episodes=args.fqi_eval_episodes,
                                  save_video=args.save_video,
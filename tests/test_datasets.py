@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from deep_rfs.utils.datasets import convert_legacy_sars, get_index, \
+    get_nb_samples_from_disk, ss_generator_from_disk
+from deep_rfs.utils.framestore import ShardWriter
+from deep_rfs.utils.manifest import MANIFEST
+
+
+class FakeModel:
+    input_shape = (4, 8, 8)
+
+    def preprocess_state(self, x, binarize=False, binarization_threshold=0.1,
+                         out=None):
+        if out is None:
+            out = np.empty(x.shape, dtype=np.float32)
+        np.divide(x, 255., out=out)
+        return out
+
+
+def write_dataset(path, episodes, shard_size=8):
+    # episodes: list of lists of rewards, one transition per reward
+    writer = ShardWriter(path, shard_size, history=4)
+    frame = 0
+    for rewards in episodes:
+        frames = [np.full((8, 8), frame + i, dtype=np.uint8) for i in range(4)]
+        frame += 4
+        for t, reward in enumerate(rewards):
+            next_frames = [np.full((8, 8), frame, dtype=np.uint8)]
+            frame += 1
+            writer.append(frames, t % 2, reward, next_frames,
+                          t == len(rewards) - 1)
+            frames = []
+        writer.end_episode()
+    writer.close()
+
+
+class StratifiedSubsetTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp() + '/'
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_reward_class_only_outside_subset(self):
+        # The reward 7 only appears in the held-out episode, which shares a
+        # shard with the training episode
+        write_dataset(self.path, [[0, 0, 1, 0, 0, 1], [0, 7, 0, 0]],
+                      shard_size=16)
+        index = get_index(self.path)
+        train = np.flatnonzero(np.asarray(index['episode']) == 0)
+        generator = ss_generator_from_disk(self.path, FakeModel(),
+                                           batch_size=4, stratify=True,
+                                           subset=train)
+        for _ in range(6):
+            S, _, W = next(generator)
+            self.assertEqual(S.shape, (4,) + FakeModel.input_shape)
+            self.assertTrue(np.all(W > 0))
+
+
+class LegacyDatasetTest(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp() + '/'
+        states = np.arange(6 * 8 * 8, dtype=np.uint8).reshape(6, 8, 8)
+        sars = np.empty((3, 5), dtype=object)
+        for t in range(3):
+            sars[t] = [states[t:t + 4], t % 2, 0., states[t + 1:t + 5], t == 2]
+        np.save(self.path + 'sars_0.npy', sars)
+
+    def tearDown(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+    def test_legacy_files_must_be_converted(self):
+        self.assertRaises(ValueError, get_nb_samples_from_disk, self.path)
+        self.assertFalse(os.path.exists(self.path + MANIFEST))
+
+        convert_legacy_sars(self.path)
+        self.assertEqual(get_nb_samples_from_disk(self.path), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+
+import numpy as np
+
+from deep_rfs.envs.synthetic import DiscreteActions, LivesInterface
+from deep_rfs.envs.vector import VectorEnv
+from deep_rfs.evaluation.evaluation import evaluate_policy
+
+
+class ConstantRewardEnv:
+    # Episodes of 3 steps with a reward of 5 at each step
+    def __init__(self, clip_reward=False):
+        self.clip_reward = clip_reward
+        self.gamma = 0.99
+        self.state_shape = (4, 8, 8)
+        self.lives = 1
+        self.env = LivesInterface(self)
+        self.action_space = DiscreteActions(2, np.random.RandomState(0))
+        self.t = 0
+
+    def reset(self):
+        self.t = 0
+        return np.zeros(self.state_shape, dtype=np.uint8)
+
+    def step(self, action):
+        self.t += 1
+        reward = 5.
+        if self.clip_reward:
+            reward = np.clip(reward, -1, 1)
+        return np.zeros(self.state_shape, dtype=np.uint8), reward, \
+            self.t == 3, {'ale.lives': self.lives}
+
+
+class ZeroPolicy:
+    epsilon = 0.
+
+    def draw_actions(self, states, absorbing, evaluation=False):
+        return np.zeros(len(states), dtype=np.int64)
+
+    def get_epsilon(self):
+        return self.epsilon
+
+    def set_epsilon(self, epsilon):
+        self.epsilon = epsilon
+
+
+class VectorEvaluationTest(unittest.TestCase):
+    def test_clip_is_set_on_the_wrapped_envs(self):
+        venv = VectorEnv([ConstantRewardEnv(clip_reward=True) for _ in range(2)])
+        score = evaluate_policy(venv, ZeroPolicy(), n_episodes=3, clip=False)[0]
+        self.assertEqual(score, 15.)
+        # The clipping of the envs is restored after the evaluation
+        self.assertTrue(all(env.clip_reward for env in venv.envs))
+
+        venv = VectorEnv([ConstantRewardEnv() for _ in range(2)])
+        score = evaluate_policy(venv, ZeroPolicy(), n_episodes=3, clip=True)[0]
+        self.assertEqual(score, 3.)
+        self.assertFalse(any(env.clip_reward for env in venv.envs))
+
+
+if __name__ == '__main__':
+    unittest.main()